@@ -2,24 +2,75 @@
 
 import streamlit as st
 from streamlit_autorefresh import st_autorefresh
-from auth import add_user, check_user, get_all_users
+from auth import add_user, check_user
+from contacts import search_contacts, is_group_handle, CONTACT_PAGE_SIZE
 # We must import all chat functions needed
 from chat import (
-    get_private_messages, add_private_message, get_or_create_shared_key,
-    set_chat_pin, is_pin_set, verify_chat_pin  # --- IMPORT NEW FUNCTIONS ---
+    get_private_messages, add_private_message, get_conversation_keys, get_or_create_conversation,
+    set_chat_pin, is_pin_set, verify_chat_pin,  # --- IMPORT NEW FUNCTIONS ---
+    get_conversation_version, get_older_private_messages,
+    get_conversation_summaries, mark_conversation_read, search_private_messages,
+    create_group, add_group_members, leave_group, get_group_members
 )
 from styles import load_css
 from themes import THEMES
+import html
 import io
-from crypto import decrypt_bytes
-from database import create_tables # <--- 1. IMPORT THE FUNCTION
+import time
+from notify import SIDEBAR_REFRESH_MS, listen_interval_seconds, wait_for_message
+from attachments import get_attachment_bytes, prefetch_attachments
+from render import render_message_groups
+import metrics
+from database import ensure_schema
+from limits import RateLimitExceeded
 
-create_tables() # <--- 2. CALL THE FUNCTION TO ENSURE TABLES ARE CREATED
+# Streamlit re-runs this file on every interaction; only the first call per process does any work.
+ensure_schema()
 
 
 # --- Page Configuration ---
 st.set_page_config(page_title="ChatApp", page_icon="😊", layout="centered")
-st_autorefresh(interval=2000, key="data_refresher")
+
+MESSAGE_WINDOW = 50  # Messages rendered at once; "Load earlier" adds this many more
+IMAGE_WINDOW = 10  # Images among the last N messages are decrypted and shown automatically
+
+def _split_names(text):
+    """Turns "alice, bob" into ['alice', 'bob']."""
+    return [name.strip() for name in text.split(",") if name.strip()]
+
+# Button callbacks run before the next rerun, while the contact radio can still be changed.
+def _open_chat(name):
+    st.session_state['chat_partner'] = name
+    st.session_state['partner_select'] = name
+
+def _create_group():
+    handle = create_group(
+        st.session_state['new_group_name'], st.session_state['username'],
+        _split_names(st.session_state['new_group_members'])
+    )
+    if handle:
+        _open_chat(handle)
+    else:
+        st.session_state['group_error'] = (
+            "That group name is taken or invalid. Use up to 32 letters, digits, '_', '.' or '-'."
+        )
+
+def _leave_group(handle):
+    leave_group(handle, st.session_state['username'])
+    st.session_state['chat_partner'] = None
+    st.session_state.pop('partner_select', None)
+    st.session_state['chat_state'].pop(handle, None)
+
+def _check_for_messages(conversation_id, since_id):
+    """Fragment body: reruns the app if the open chat has a message newer than since_id.
+
+    Only asks the hub what has been published, without waiting.
+    """
+    notified = st.session_state.setdefault('notified_ids', {})
+    latest = wait_for_message(conversation_id, max(since_id, notified.get(conversation_id, 0)), timeout=0)
+    if latest:
+        notified[conversation_id] = latest
+        st.rerun()
 
 def main():
     # --- Session State and CSS ---
@@ -27,10 +78,17 @@ def main():
         st.session_state.update({
             'logged_in': False, 'username': "",
             'chat_partner': None, 'theme': "Rose Petal",
-            'unlocked_chats': {}  # --- NEW: Tracks which chats are unlocked ---
+            'unlocked_chats': {},  # --- NEW: Tracks which chats are unlocked ---
+            'chat_state': {}  # Version, PIN status and messages already fetched, per chat partner
         })
     
-    st.markdown(load_css(st.session_state['theme']), unsafe_allow_html=True)
+    with metrics.phase("app.css"):
+        st.markdown(load_css(st.session_state['theme']), unsafe_allow_html=True)
+
+    # Only the sidebar relies on this refresh; the open chat is refreshed by
+    # _check_for_messages when a message arrives
+    idle_seconds = time.time() - st.session_state.setdefault('last_activity', time.time())
+    st_autorefresh(interval=SIDEBAR_REFRESH_MS, key="data_refresher")
     
     # --- Authentication Flow (remains unchanged) ---
     if not st.session_state['logged_in']:
@@ -60,30 +118,54 @@ def main():
     # --- Logged-In Interface ---
     
     # Sidebar Setup
-    with st.sidebar:
+    with st.sidebar, metrics.phase("app.sidebar"):
         st.header(f"Welcome, {st.session_state['username']}!")
-        users = get_all_users(st.session_state['username'])
-        users.sort()
-        if users:
-            st.markdown("---")
-            st.subheader("Contacts")
-            default_index = 0
-            if st.session_state['chat_partner'] in users:
-                default_index = users.index(st.session_state['chat_partner'])
-            elif st.session_state['chat_partner'] is None and users:
+        st.markdown("---")
+        st.subheader("Contacts")
+        # Only one page of the directory is ever loaded
+        contact_query = st.text_input("Search contacts", key="contact_query", placeholder="Search...").strip()
+        if st.session_state.get('contact_query_seen') != contact_query:
+            st.session_state['contact_query_seen'] = contact_query
+            st.session_state['contact_cursors'] = [None]  # `after` cursor of every page visited so far
+        cursors = st.session_state.setdefault('contact_cursors', [None])
+        users, has_next_page = search_contacts(st.session_state['username'], contact_query, after=cursors[-1])
+        # The next page starts after this page's last directory name, whatever gets mixed in below
+        next_cursor = users[-1] if users else None
+        # Chats with recent activity go first, with an unread badge
+        summaries = get_conversation_summaries(st.session_state['username'], limit=CONTACT_PAGE_SIZE)
+        unread_counts = {s['partner_username']: s['unread_count'] for s in summaries}
+        if not contact_query and len(cursors) == 1:
+            recent = [s['partner_username'] for s in summaries]
+            users = recent + [name for name in users if name not in unread_counts]
+        if users or st.session_state['chat_partner']:
+            if st.session_state['chat_partner'] is None:
                 st.session_state['chat_partner'] = users[0]
+            if st.session_state['chat_partner'] not in users:
+                # Keep the open chat selectable while browsing other pages
+                users = [st.session_state['chat_partner']] + users
+            default_index = users.index(st.session_state['chat_partner'])
             
             selected_partner = st.radio(
-                "Select a contact to chat with:", users, key='partner_select', index=default_index
+                "Select a contact to chat with:", users, key='partner_select', index=default_index,
+                format_func=lambda name: f"{name} ({unread_counts[name]})" if unread_counts.get(name) else name
             )
             
             # --- MODIFIED: Reset lock status when changing chats ---
             if selected_partner != st.session_state['chat_partner']:
                 st.session_state['chat_partner'] = selected_partner
+                st.session_state['last_activity'] = time.time()
                 st.session_state['unlocked_chats'] = {} # Lock all chats
                 st.rerun()
             
             st.session_state['chat_partner'] = selected_partner
+
+            prev_col, next_col = st.columns(2)
+            if len(cursors) > 1 and prev_col.button("◀ Previous", key="contacts_prev", use_container_width=True):
+                cursors.pop()
+                st.rerun()
+            if has_next_page and next_col.button("Next ▶", key="contacts_next", use_container_width=True):
+                cursors.append(next_cursor)
+                st.rerun()
             
             # --- NEW: UI to set a chat PIN ---
             with st.expander("Chat Security"):
@@ -101,9 +183,18 @@ def main():
                     else:
                         st.warning("PIN must be 4 digits.")
 
+        elif contact_query:
+            st.info("No contacts match your search.")
         else:
             st.info("No other users registered yet.")
 
+        with st.expander("New group"):
+            st.text_input("Group name", key="new_group_name", placeholder="team")
+            st.text_input("Members", key="new_group_members", placeholder="alice, bob")
+            st.button("Create group", key="create_group", on_click=_create_group)
+            if 'group_error' in st.session_state:
+                st.error(st.session_state.pop('group_error'))
+
         # Theme Selector and Logout (remains unchanged)
         st.markdown("---")
         st.subheader("Theme")
@@ -115,13 +206,31 @@ def main():
             st.session_state.clear()
             st.rerun()
 
+        # Only shown when started with CHAT_APP_METRICS=1
+        if metrics.ENABLED:
+            with st.expander("Debug: last rerun timings"):
+                st.code(metrics.format_breakdown(st.session_state.get('last_rerun_timings', {})) or "No data yet.")
+
     # --- Chat Interface (Main Logic Change) ---
     if st.session_state['chat_partner']:
         partner = st.session_state['chat_partner']
         username = st.session_state['username']
         
+        # Anything cached for this chat is still valid while its version is unchanged
+        try:
+            version = get_conversation_version(username, partner)
+        except PermissionError:
+            st.info(f"You are not a member of {partner}.")
+            return
+        chat_state = st.session_state.setdefault('chat_state', {}).setdefault(
+            partner, {'pin_version': None, 'pin_required': False, 'messages_version': None, 'messages': []}
+        )
+
         # --- NEW: Check if PIN is required and if chat is unlocked ---
-        pin_required = is_pin_set(username, partner)
+        if chat_state['pin_version'] != version:
+            chat_state['pin_required'] = is_pin_set(username, partner)
+            chat_state['pin_version'] = version
+        pin_required = chat_state['pin_required']
         is_unlocked = st.session_state.get('unlocked_chats', {}).get(partner, False)
         
         # --- A. SHOW THE LOCK SCREEN ---
@@ -140,9 +249,47 @@ def main():
         # --- B. SHOW THE CHAT INTERFACE (if not locked) ---
         else:
             # st.markdown('<div class="chat-page-container">', unsafe_allow_html=True)
-            st.markdown(f'<div class="chat-header">{partner}</div>', unsafe_allow_html=True)
-            chat_key = get_or_create_shared_key(username, partner)
-            messages = get_private_messages(username, partner)
+            st.markdown(f'<div class="chat-header">{html.escape(partner)}</div>', unsafe_allow_html=True)
+            chat_key = get_conversation_keys(username, partner)
+
+            if is_group_handle(partner):
+                if chat_state.get('members_version') != version:
+                    chat_state['members'] = get_group_members(partner, username)
+                    chat_state['members_version'] = version
+                with st.expander(f"👥 Members ({len(chat_state['members'])})"):
+                    st.caption(", ".join(chat_state['members']))
+                    new_members = st.text_input("Add members", key=f"add_members_{partner}", placeholder="alice, bob")
+                    if st.button("Add", key=f"add_members_button_{partner}") and new_members.strip():
+                        added = add_group_members(partner, username, _split_names(new_members))
+                        st.success(f"Added {added} member(s).")
+                    st.button("Leave group", key=f"leave_{partner}", on_click=_leave_group, args=(partner,))
+
+            with st.expander("🔍 Search this chat"):
+                search_query = st.text_input(
+                    "Search messages", key=f"search_{partner}", placeholder="Find words...",
+                    label_visibility="collapsed"
+                ).strip()
+                if search_query:
+                    results = search_private_messages(username, partner, search_query)
+                    for kind, item in render_message_groups(results, username):
+                        if kind == 'html':
+                            st.markdown(item, unsafe_allow_html=True)
+                    if not results:
+                        st.caption("No messages found.")
+
+            # Only ask the database for messages newer than the ones we already have
+            messages = chat_state['messages']
+            if chat_state['messages_version'] != version:
+                if messages:
+                    messages.extend(get_private_messages(username, partner, since_id=messages[-1]['id']))
+                else:
+                    # First time this chat is opened: load only the latest page
+                    messages.extend(get_older_private_messages(username, partner, limit=MESSAGE_WINDOW))
+                    chat_state['has_older'] = len(messages) == MESSAGE_WINDOW
+                chat_state['messages_version'] = version
+                st.session_state['last_activity'] = time.time()
+                mark_conversation_read(username, partner)
+            chat_state.setdefault('window', MESSAGE_WINDOW)
             st.markdown('<div class="chat-container">', unsafe_allow_html=True) 
 
             if not messages:
@@ -151,51 +298,60 @@ def main():
                     unsafe_allow_html=True
                 )
             else:
-                # Message rendering loop (remains unchanged)
-                for msg in messages:
-                    is_user_message = (msg['sender_username'] == username)
-                    row_class = "user-message-row" if is_user_message else "other-message-row"
-                    message_class = "chat-message user-message" if is_user_message else "chat-message other-message"
-                    if msg['message_type'] == 'text':
-                        st.markdown(f"""
-                            <div class="message-row {row_class}">
-                                <div class="{message_class}">
-                                    <span class="sender">{msg['sender_username']}</span>
-                                    <div class="message-content">{msg['message']}</div> 
-                                    <span class="timestamp">{msg['timestamp'].split('.')[0]}</span>
-                                </div>
-                            </div>
-                        """, unsafe_allow_html=True)
-                    else:
-                        st.markdown(f"""
-                            <div class="message-row {row_class}">
-                                <div class="{message_class}">
-                                    <span class="sender">{msg['sender_username']}</span>
-                                    <div class="file-content">
-                        """, unsafe_allow_html=True)
-                        try:
-                            with open(msg['file_path'], 'rb') as f: encrypted_bytes = f.read()
-                            decrypted_bytes = decrypt_bytes(encrypted_bytes, chat_key)
-                            if decrypted_bytes:
-                                if msg['message_type'] == 'image':
-                                    st.image(io.BytesIO(decrypted_bytes), caption=msg['filename'])
-                                else:
-                                    st.download_button(
-                                        label=f"⬇️ Download {msg['filename']}", data=decrypted_bytes,
-                                        file_name=msg['filename'], mime=msg['message_type']
-                                    )
-                            else: st.warning("⚠️ Could not decrypt file content.")
-                        except FileNotFoundError: st.error("Error: Encrypted file not found.")
-                        except Exception as e: st.error(f"An error occurred: {e}")
-                        st.markdown(f"""
-                                    </div><span class="timestamp">{msg['timestamp'].split('.')[0]}</span>
-                                </div></div>
-                        """, unsafe_allow_html=True)
-            
+                if len(messages) > chat_state['window'] or chat_state.get('has_older'):
+                    if st.button("⬆️ Load earlier messages", key=f"load_earlier_{partner}"):
+                        chat_state['window'] += MESSAGE_WINDOW
+                        missing = chat_state['window'] - len(messages)
+                        if missing > 0 and chat_state.get('has_older'):
+                            older = get_older_private_messages(
+                                username, partner, before_id=messages[0]['id'], limit=missing
+                            )
+                            messages[:0] = older
+                            chat_state['has_older'] = len(older) == missing
+                        st.rerun()
+
+                # Only the last `window` messages are rendered, as a few HTML blocks
+                visible = messages[-chat_state['window']:]
+                first_image_index = len(visible) - IMAGE_WINDOW
+                position = {msg['id']: index for index, msg in enumerate(visible)}
+                revealed = st.session_state.setdefault('revealed_attachments', set())
+                # Decrypt every attachment that is about to be shown in one parallel batch
+                prefetch_attachments([
+                    msg['file_path'] for index, msg in enumerate(visible)
+                    if msg['id'] in revealed or (msg['message_type'] == 'image' and index >= first_image_index)
+                ], chat_key)
+                with metrics.phase("app.render_messages"):
+                    for kind, item in render_message_groups(visible, username):
+                        if kind == 'html':
+                            st.markdown(item, unsafe_allow_html=True)
+                            continue
+                        msg = item
+                        # Only decrypt recent images and attachments the user asked for
+                        is_image = msg['message_type'] == 'image'
+                        in_image_window = position[msg['id']] >= first_image_index
+                        if msg['id'] not in revealed and not (is_image and in_image_window):
+                            label = f"🖼️ Show {msg['filename']}" if is_image else f"📎 Prepare {msg['filename']} for download"
+                            if st.button(label, key=f"reveal_{msg['id']}"):
+                                revealed.add(msg['id'])
+                                st.rerun()
+                        else:
+                            try:
+                                decrypted_bytes = get_attachment_bytes(msg['file_path'], chat_key)
+                                if decrypted_bytes:
+                                    if is_image:
+                                        st.image(io.BytesIO(decrypted_bytes), caption=msg['filename'])
+                                    else:
+                                        st.download_button(
+                                            label=f"⬇️ Download {msg['filename']}", data=decrypted_bytes,
+                                            file_name=msg['filename'], mime=msg['message_type']
+                                        )
+                                else: st.warning("⚠️ Could not decrypt file content.")
+                            except FileNotFoundError: st.error("Error: Encrypted file not found.")
+                            except Exception as e: st.error(f"An error occurred: {e}")
             st.markdown('</div>', unsafe_allow_html=True) 
             
             # Message input form (remains unchanged)
-            with st.form(key='message_form', clear_on_submit=True):
+            with st.form(key='message_form', clear_on_submit=True), metrics.phase("app.send_form"):
                 col1, col2 = st.columns([5, 1])
                 with col1:
                     message_text = st.text_input("Your message...", placeholder="Type...", label_visibility="collapsed")
@@ -203,10 +359,21 @@ def main():
                 with col2:
                     send_pressed = st.form_submit_button("Send", use_container_width=True) 
                 if send_pressed:
-                    if uploaded_file: add_private_message(sender=username, receiver=partner, uploaded_file=uploaded_file)
-                    elif message_text: add_private_message(sender=username, receiver=partner, message_text=message_text)
-                    else: st.toast("Please type a message or upload a file."); st.stop() 
-                    st.rerun()
+                    st.session_state['last_activity'] = time.time()
+                    if not uploaded_file and not message_text:
+                        st.toast("Please type a message or upload a file."); st.stop()
+                    try:
+                        if uploaded_file: add_private_message(sender=username, receiver=partner, uploaded_file=uploaded_file)
+                        else: add_private_message(sender=username, receiver=partner, message_text=message_text)
+                    except RateLimitExceeded as e:
+                        st.warning(str(e))
+                    else:
+                        st.rerun()
+
+            # Checks for new messages often while the chat is busy and backs off while it is idle;
+            # the interval is picked up again on every full rerun
+            listen = st.fragment(run_every=listen_interval_seconds(idle_seconds))(_check_for_messages)
+            listen(get_or_create_conversation(username, partner)['id'], messages[-1]['id'] if messages else 0)
             
             st.markdown('</div>', unsafe_allow_html=True) 
 
@@ -214,4 +381,13 @@ def main():
         st.info("Select a contact from the sidebar to start chatting.")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    if metrics.ENABLED:
+        metrics.start_rerun()
+        try:
+            main()
+        finally:
+            timings = metrics.finish_rerun()
+            st.session_state['last_rerun_timings'] = timings
+            print(f"Rerun took {timings['rerun.total']['seconds'] * 1000:.1f} ms")
+    else:
+        main()
\ No newline at end of file
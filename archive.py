@@ -0,0 +1,252 @@
+# archive.py
+
+import io
+import json
+import os
+import zlib
+from cache import LRUCache
+from crypto import decrypt_file, encrypt_file, get_fernet
+from database import ensure_schema, get_db_connection
+from metrics import instrument
+import writer
+
+# Old messages are moved out of the messages table into segment files, so the
+# live table and its indexes stay small enough to sit in the page cache. A
+# segment holds up to SEGMENT_MAX_MESSAGES consecutive messages of one
+# conversation as zlib-compressed JSON, encrypted with the conversation key in
+# the chunked container from crypto.py. Segment files are never modified; a
+# key rotation writes a replacement. archive_segments indexes their id and
+# timestamp ranges. Only the oldest messages of a conversation are archived,
+# so every archived id is lower than every live one.
+ARCHIVE_DIR = "archive"
+ARCHIVE_AFTER_DAYS = 90        # Messages older than this are archived by archive_old_messages
+SEGMENT_MAX_MESSAGES = 1000    # Messages per segment file
+SEGMENT_CACHE_MAX_BYTES = 16 * 1024 * 1024  # Decoded segments kept in memory
+
+_COLUMNS = (
+    'id', 'conversation_id', 'sender_username', 'receiver_username', 'timestamp', 'message_type',
+    'encrypted_message', 'encrypted_file_path', 'original_filename', 'key_version',
+)
+
+# segment path -> (rows, decompressed size)
+_segment_cache = LRUCache(max_items=256, max_bytes=SEGMENT_CACHE_MAX_BYTES, sizeof=lambda entry: entry[1])
+
+def segment_path(conversation_id, first_id, last_id, key_version):
+    """Returns where the segment with the given id range and key version is stored."""
+    return os.path.join(ARCHIVE_DIR, str(conversation_id), f"{first_id:012d}-{last_id:012d}.v{key_version}.seg")
+
+def _encode_row(row):
+    record = {column: row[column] for column in _COLUMNS}
+    if isinstance(record['encrypted_message'], bytes):
+        record['encrypted_message'] = record['encrypted_message'].decode('ascii')  # Fernet tokens are ASCII
+    return record
+
+@instrument("archive.write_segment", bytes_from=lambda result, path, rows, key: os.path.getsize(path))
+def write_segment(path, rows, key):
+    """Compresses and encrypts message rows into a new segment file."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    data = json.dumps([_encode_row(row) for row in rows], separators=(",", ":")).encode()
+    encrypt_file(io.BytesIO(zlib.compress(data)), path, key)
+
+@instrument("archive.read_segment")
+def read_segment(path, keys):
+    """Returns the message rows stored in a segment, oldest first, or [] if it cannot be decrypted."""
+    cached = _segment_cache.get(path)
+    if cached is not None:
+        return cached[0]
+    data = decrypt_file(path, keys)
+    if data is None:
+        return []
+    data = zlib.decompress(data)
+    rows = json.loads(data)
+    _segment_cache.put(path, (rows, len(data)))
+    return rows
+
+def _find_segments(conversation_id, condition, params, order="ASC"):
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            f"""
+            SELECT first_id, last_id, path, key_version FROM archive_segments
+            WHERE conversation_id = ? AND {condition}
+            ORDER BY first_id {order}
+            """,
+            (conversation_id, *params)
+        )
+        return cursor.fetchall()
+
+def _retrying(read):
+    """Runs read() a second time if a segment it used was replaced by a key rotation meanwhile."""
+    try:
+        return read()
+    except FileNotFoundError:
+        return read()
+
+
+# --- Reading ---
+def read_archived_before(conversation_id, keys, before_id, limit):
+    """Returns up to `limit` archived messages with an id below before_id, oldest first.
+
+    Segments are read newest first and only until enough messages are found.
+    """
+    def read():
+        rows = []
+        for segment in _find_segments(conversation_id, "first_id < ?", (before_id,), "DESC"):
+            rows[:0] = [row for row in read_segment(segment['path'], keys) if row['id'] < before_id]
+            if len(rows) >= limit:
+                break
+        return rows[-limit:] if limit else []
+    return _retrying(read)
+
+def iter_archived_segments(conversation_id, keys, since_id=0):
+    """Yields the archived messages with an id above since_id one segment at a time, oldest first."""
+    for segment in _find_segments(conversation_id, "last_id > ?", (since_id,)):
+        yield [row for row in read_segment(segment['path'], keys) if row['id'] > since_id]
+
+def read_archived_after(conversation_id, keys, since_id):
+    """Returns every archived message with an id above since_id, oldest first."""
+    return _retrying(lambda: [
+        row for rows in iter_archived_segments(conversation_id, keys, since_id) for row in rows
+    ])
+
+def read_archived_ids(conversation_id, keys, message_ids):
+    """Returns the archived messages among message_ids, oldest first."""
+    if not message_ids:
+        return []
+    wanted = set(message_ids)
+
+    def read():
+        rows = []
+        segments = _find_segments(conversation_id, "first_id <= ? AND last_id >= ?", (max(wanted), min(wanted)))
+        for segment in segments:
+            rows.extend(row for row in read_segment(segment['path'], keys) if row['id'] in wanted)
+        return rows
+    return _retrying(read)
+
+
+# --- Archiving ---
+@instrument("archive.archive_conversation")
+def archive_conversation(conversation_id, older_than_days=ARCHIVE_AFTER_DAYS, segment_size=SEGMENT_MAX_MESSAGES):
+    """Moves a conversation's messages older than older_than_days into new segments.
+
+    Each segment is written to disk first and then, in one transaction,
+    indexed and deleted from the messages table, so a crash in between only
+    leaves a file that the next run overwrites. Returns the number of
+    messages archived.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT shared_key, key_version FROM conversations WHERE id = ?", (conversation_id,))
+        conversation = cursor.fetchone()
+        # Archived ids must stay below live ones, so the cut is just below the
+        # oldest recent message. Ids are not in timestamp order: imported
+        # messages keep their old timestamps under new, higher ids, and those
+        # stay live until everything before them is old too.
+        cursor.execute(
+            """
+            SELECT COALESCE(
+                (SELECT MIN(id) - 1 FROM messages WHERE conversation_id = ? AND timestamp >= datetime('now', ?)),
+                (SELECT MAX(id) FROM messages WHERE conversation_id = ?)
+            )
+            """,
+            (conversation_id, f"-{older_than_days} days", conversation_id)
+        )
+        upper = cursor.fetchone()[0]
+    if conversation is None or upper is None:
+        return 0
+
+    archived = 0
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM messages WHERE conversation_id = ? AND id <= ? ORDER BY id LIMIT ?",
+                (conversation_id, upper, segment_size)
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        first, last = rows[0], rows[-1]
+        # Rows a key rotation has not re-encrypted yet keep the segment labelled
+        # with their older version, so that rewrite_segments still picks it up.
+        key_version = min(row['key_version'] for row in rows)
+        path = segment_path(conversation_id, first['id'], last['id'], key_version)
+        write_segment(path, rows, conversation['shared_key'])
+
+        def job(cursor, first=first, last=last, count=len(rows), path=path, key_version=key_version):
+            cursor.execute(
+                """
+                INSERT INTO archive_segments (conversation_id, first_id, last_id, first_timestamp,
+                                              last_timestamp, message_count, path, key_version)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (conversation_id, first['id'], last['id'], first['timestamp'], last['timestamp'],
+                 count, path, key_version)
+            )
+            cursor.execute(
+                "DELETE FROM messages WHERE conversation_id = ? AND id BETWEEN ? AND ?",
+                (conversation_id, first['id'], last['id'])
+            )
+        writer.run(job)
+        archived += len(rows)
+    return archived
+
+def archive_old_messages(older_than_days=ARCHIVE_AFTER_DAYS, segment_size=SEGMENT_MAX_MESSAGES):
+    """Archives old messages in every conversation; returns {conversation_id: messages archived}."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT DISTINCT conversation_id FROM messages WHERE timestamp < datetime('now', ?)",
+            (f"-{older_than_days} days",)
+        )
+        conversation_ids = [row['conversation_id'] for row in cursor.fetchall()]
+    return {cid: archive_conversation(cid, older_than_days, segment_size) for cid in conversation_ids}
+
+def rewrite_segments(conversation_id, version, keys):
+    """Replaces segments written under a key older than `version` with ones under keys[0].
+
+    Text messages inside are re-encrypted too. Used by key rotation; returns
+    the number of segments rewritten.
+    """
+    from cryptography.fernet import InvalidToken
+    fernet = get_fernet(keys)
+    rewritten = 0
+    for segment in _find_segments(conversation_id, "key_version < ?", (version,)):
+        rows = read_segment(segment['path'], keys)
+        if not rows:
+            continue
+        rotated = []
+        for row in rows:
+            row = dict(row)
+            if row['message_type'] == 'text' and row['key_version'] < version:
+                try:
+                    row['encrypted_message'] = fernet.rotate(row['encrypted_message'])
+                except InvalidToken:
+                    print(f"Skipping archived message {row['id']}: it does not decrypt with any key")
+                    rotated.append(row)
+                    continue
+            row['key_version'] = version
+            rotated.append(row)
+        path = segment_path(conversation_id, segment['first_id'], segment['last_id'], version)
+        write_segment(path, rotated, keys[0])
+
+        def job(cursor, segment=segment, path=path):
+            cursor.execute(
+                "UPDATE archive_segments SET path = ?, key_version = ? WHERE conversation_id = ? AND first_id = ?",
+                (path, version, conversation_id, segment['first_id'])
+            )
+        writer.run(job)
+        _segment_cache.pop(segment['path'])
+        os.remove(segment['path'])
+        rewritten += 1
+    return rewritten
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Move old messages into compressed, encrypted segment files.")
+    parser.add_argument("--days", type=int, default=ARCHIVE_AFTER_DAYS, help="archive messages older than this")
+    parser.add_argument("--segment-size", type=int, default=SEGMENT_MAX_MESSAGES, help="messages per segment")
+    args = parser.parse_args()
+    ensure_schema()
+    results = archive_old_messages(args.days, args.segment_size)
+    print(f"Archived {sum(results.values())} messages from {len(results)} conversation(s).")
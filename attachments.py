@@ -0,0 +1,246 @@
+# attachments.py
+
+import base64
+import hashlib
+import hmac
+import os
+import sys
+import time
+from cache import LRUCache
+from crypto import decrypt_file, decrypt_files, encrypt_stream
+from database import get_db_connection
+from metrics import instrument
+
+# Encrypted blobs are stored under a keyed hash of their plaintext, sharded by
+# the first hex digits: uploads/ab/cd/abcd....enc. The hash key comes from the
+# conversation key, so the same file sent twice in one chat is stored once and
+# the file name reveals nothing to anyone without the key.
+UPLOADS_DIR = "uploads"
+SHARD_LEVELS = 2
+GC_GRACE_SECONDS = 3600  # Unreferenced blobs younger than this are left alone by collect_garbage
+
+ATTACHMENT_CACHE_MAX_BYTES = 64 * 1024 * 1024  # Decrypted attachments kept in memory
+
+# Optional second tier on local disk. Decrypted files are written there in the
+# clear, so it is off unless ATTACHMENT_DISK_CACHE is set to True.
+ATTACHMENT_DISK_CACHE = False
+ATTACHMENT_DISK_CACHE_MAX_BYTES = 512 * 1024 * 1024
+
+def _remove_disk_entry(file_path, entry):
+    try:
+        os.remove(entry['path'])
+    except FileNotFoundError:
+        pass
+
+# encrypted_file_path -> decrypted bytes
+_memory_cache = LRUCache(max_items=sys.maxsize, max_bytes=ATTACHMENT_CACHE_MAX_BYTES, sizeof=len)
+# encrypted_file_path -> {'path': ..., 'size': ...} of the decrypted copy on disk
+_disk_cache = LRUCache(
+    max_items=sys.maxsize, max_bytes=ATTACHMENT_DISK_CACHE_MAX_BYTES,
+    sizeof=lambda entry: entry['size'], on_evict=_remove_disk_entry
+)
+_disk_cache_dir = None
+
+def _disk_path(file_path):
+    global _disk_cache_dir
+    if _disk_cache_dir is None:
+        import tempfile
+        _disk_cache_dir = tempfile.mkdtemp(prefix="chatapp-attachments-")
+    return os.path.join(_disk_cache_dir, hashlib.sha256(file_path.encode()).hexdigest())
+
+def _read_from_disk(file_path):
+    entry = _disk_cache.get(file_path)
+    if entry is None:
+        return None
+    try:
+        with open(entry['path'], 'rb') as f:
+            return f.read()
+    except FileNotFoundError:
+        _disk_cache.pop(file_path)
+        return None
+
+def _write_to_disk(file_path, data):
+    path = _disk_path(file_path)
+    with open(path, 'wb') as f:
+        f.write(data)
+    if not _disk_cache.put(file_path, {'path': path, 'size': len(data)}):
+        os.remove(path)
+
+@instrument("attachments.get_attachment_bytes", bytes_from=lambda result, path, key: len(result or b""))
+def get_attachment_bytes(file_path, key):
+    """Returns the decrypted contents of an attachment, or None if it cannot be decrypted.
+
+    Looks in the memory cache, then the disk cache, and only decrypts the file
+    when neither has it. Raises FileNotFoundError if the encrypted file is missing.
+    """
+    data = _memory_cache.get(file_path)
+    if data is not None:
+        return data
+    data = _read_from_disk(file_path) if ATTACHMENT_DISK_CACHE else None
+    if data is None:
+        data = decrypt_file(file_path, key)
+        if data is None:
+            return None
+        if ATTACHMENT_DISK_CACHE:
+            _write_to_disk(file_path, data)
+    _memory_cache.put(file_path, data)
+    return data
+
+def prefetch_attachments(file_paths, key):
+    """Decrypts the attachments that are not cached yet in parallel and caches them.
+
+    Missing or undecryptable files are skipped; get_attachment_bytes reports them.
+    """
+    missing = [path for path in dict.fromkeys(file_paths) if _memory_cache.get(path) is None]
+    for path, data in zip(missing, decrypt_files(missing, key)):
+        if isinstance(data, bytes):
+            _memory_cache.put(path, data)
+
+def forget_attachment(file_path):
+    """Drops an attachment from both cache tiers, e.g. after it is re-encrypted or deleted."""
+    _memory_cache.pop(file_path)
+    entry = _disk_cache.pop(file_path)
+    if entry:
+        _remove_disk_entry(file_path, entry)
+
+def get_attachment_cache_stats():
+    """Returns hit/miss/eviction counters for the memory and disk tiers."""
+    return {'memory': _memory_cache.stats(), 'disk': _disk_cache.stats()}
+
+def clear_disk_cache():
+    """Deletes every decrypted attachment spilled to disk."""
+    global _disk_cache_dir
+    _disk_cache.clear()
+    if _disk_cache_dir:
+        import shutil
+        shutil.rmtree(_disk_cache_dir, ignore_errors=True)
+        _disk_cache_dir = None
+
+
+# --- Content-addressed storage ---
+class _HashingReader:
+    """Wraps a readable file object and MACs everything read through it."""
+
+    def __init__(self, source, mac):
+        self._source = source
+        self._mac = mac
+        self.size = 0
+
+    def read(self, size=-1):
+        data = self._source.read(size)
+        self._mac.update(data)
+        self.size += len(data)
+        return data
+
+    def hexdigest(self):
+        return self._mac.hexdigest()
+
+def _content_mac(key):
+    content_key = hmac.new(base64.urlsafe_b64decode(key), b"chatapp content address", hashlib.sha256).digest()
+    return hmac.new(content_key, digestmod=hashlib.sha256)
+
+def blob_path(digest):
+    """Returns the sharded path for a blob with the given hex digest."""
+    shards = [digest[2 * i:2 * i + 2] for i in range(SHARD_LEVELS)]
+    return os.path.join(UPLOADS_DIR, *shards, f"{digest}.enc")
+
+@instrument("attachments.store_attachment", bytes_from=lambda result, source, key, **kwargs: result[1])
+def store_attachment(source, key, address_key=None):
+    """Encrypts a readable file object into the blob store in one streaming pass.
+
+    Returns (blob_path, plaintext_size). If the conversation already has a blob
+    with the same content, the new copy is discarded and the existing path is
+    returned. address_key (the conversation's first key by default, key)
+    derives the content address, so that it does not change when the
+    encryption key is rotated; a holder of that key can therefore still tell
+    whether a known file was sent after a rotation. Callers must record the reference with
+    add_attachment_reference.
+    """
+    os.makedirs(UPLOADS_DIR, exist_ok=True)
+    reader = _HashingReader(source, _content_mac(address_key or key))
+    temp_path = os.path.join(UPLOADS_DIR, f".incoming-{os.urandom(16).hex()}")
+    try:
+        with open(temp_path, "wb") as f:
+            for block in encrypt_stream(reader, key):
+                f.write(block)
+        path = blob_path(reader.hexdigest())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            os.utime(path)  # Keeps collect_garbage away until the new reference is committed
+        else:
+            os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    return path, reader.size
+
+def add_attachment_reference(cursor, path, conversation_id, size, key_version=1):
+    """Write-queue job step: counts one more message pointing at a blob."""
+    cursor.execute(
+        """
+        INSERT INTO attachment_blobs (path, conversation_id, size, refcount, key_version) VALUES (?, ?, ?, 1, ?)
+        ON CONFLICT (path) DO UPDATE SET refcount = refcount + 1
+        """,
+        (path, conversation_id, size, key_version)
+    )
+
+def release_attachment_reference(cursor, path):
+    """Write-queue job step: counts one less message pointing at a blob.
+
+    The file itself is removed later by collect_garbage.
+    """
+    cursor.execute("UPDATE attachment_blobs SET refcount = refcount - 1 WHERE path = ?", (path,))
+    forget_attachment(path)
+
+def collect_garbage(grace_seconds=GC_GRACE_SECONDS, dry_run=False):
+    """Deletes blobs no message refers to any more, and stray files under UPLOADS_DIR.
+
+    Files modified within grace_seconds are kept, so uploads whose message is
+    still being committed are never removed. Returns the list of deleted paths.
+    """
+    cutoff = time.time() - grace_seconds
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT path, refcount FROM attachment_blobs")
+        known = {row['path']: row['refcount'] for row in cursor.fetchall()}
+
+    removed = []
+    for root, _, files in os.walk(UPLOADS_DIR):
+        for name in files:
+            path = os.path.join(root, name)
+            if known.get(path, 0) > 0:
+                continue
+            try:
+                if os.path.getmtime(path) > cutoff:
+                    continue
+                if not dry_run:
+                    os.remove(path)
+                    forget_attachment(path)
+            except FileNotFoundError:
+                continue
+            removed.append(path)
+
+    if not dry_run:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            # Only rows whose count is still zero: a blob may have been re-referenced meanwhile.
+            cursor.executemany(
+                "DELETE FROM attachment_blobs WHERE path = ? AND refcount <= 0",
+                [(path,) for path in removed if path in known]
+            )
+            conn.commit()
+    return removed
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Attachment storage maintenance.")
+    parser.add_argument("command", choices=["gc"])
+    parser.add_argument("--grace", type=int, default=GC_GRACE_SECONDS, help="keep files newer than this many seconds")
+    parser.add_argument("--dry-run", action="store_true", help="only list what would be deleted")
+    args = parser.parse_args()
+    removed = collect_garbage(args.grace, args.dry_run)
+    for path in removed:
+        print(path)
+    print(f"{'Would remove' if args.dry_run else 'Removed'} {len(removed)} file(s).")
@@ -0,0 +1,273 @@
+# benchmark.py
+
+"""Benchmarks the chat data path (auth, chat, crypto, database) against a throwaway database.
+
+    python benchmark.py --users 1000 --history-lengths 100 1000 10000 --output results.json
+    python benchmark.py --threads 8 --messages 200
+
+Every run works in a fresh temporary directory, so chat_app.db and uploads/ of
+the real app are never touched. Results are printed and written as JSON so two
+runs can be diffed.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+
+import attachments
+import auth
+import chat
+import contacts
+import crypto
+import database
+import limits
+
+
+class _Upload(io.BytesIO):
+    """Stands in for Streamlit's UploadedFile."""
+
+    def __init__(self, data, name="bench.bin", type="application/octet-stream"):
+        super().__init__(data)
+        self.name = name
+        self.type = type
+        self.size = len(data)
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    fn(*args, **kwargs)
+    return time.perf_counter() - start
+
+def _summary(samples):
+    """Turns a list of durations in seconds into latency stats in milliseconds."""
+    samples = sorted(samples)
+    pick = lambda q: samples[min(len(samples) - 1, int(q * len(samples)))] * 1000
+    return {
+        'count': len(samples),
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'p50_ms': pick(0.50),
+        'p95_ms': pick(0.95),
+        'p99_ms': pick(0.99),
+        'max_ms': samples[-1] * 1000,
+    }
+
+def _reset_caches():
+    """Forgets everything cached in memory, so the next read is a cold one."""
+    chat._conversation_cache.clear()
+    chat._decrypted_cache.clear()
+    attachments._memory_cache.clear()
+    contacts.invalidate_directory()
+
+
+def seed(num_users, num_conversations, messages_per_conversation, attachment_size):
+    """Creates users, random conversations between them and their messages."""
+    usernames = [f"user{i:06d}" for i in range(num_users)]
+    for name in usernames:
+        auth.add_user(name, "password")
+    pairs = set()
+    while len(pairs) < min(num_conversations, num_users * (num_users - 1) // 2):
+        pairs.add(tuple(sorted(random.sample(usernames, 2))))
+    payload = os.urandom(attachment_size) if attachment_size else None
+    for u1, u2 in pairs:
+        for i in range(messages_per_conversation):
+            sender, receiver = (u1, u2) if i % 2 == 0 else (u2, u1)
+            if payload and i % 10 == 9:
+                chat.add_private_message(sender, receiver, uploaded_file=_Upload(payload))
+            else:
+                chat.add_private_message(sender, receiver, message_text=f"message {i} " + "x" * 40)
+    return usernames, sorted(pairs)
+
+
+def bench_send(count):
+    """add_private_message throughput from a single session."""
+    auth.add_user("send_a", "password")
+    auth.add_user("send_b", "password")
+    elapsed = [_timed(chat.add_private_message, "send_a", "send_b", message_text="hello there")
+               for _ in range(count)]
+    return {'messages': count, 'per_second': count / sum(elapsed), 'latency': _summary(elapsed)}
+
+def bench_group_send(sizes, count):
+    """add_private_message latency to groups of each size; should match a direct message."""
+    results = []
+    for size in sizes:
+        members = [f"group{size}_{i}" for i in range(size)]
+        for name in members:
+            auth.add_user(name, "password")
+        handle = chat.create_group(f"bench{size}", members[0], members)
+        elapsed = [_timed(chat.add_private_message, members[0], handle, message_text="hello team")
+                   for _ in range(count)]
+        results.append({'members': size, 'per_second': count / sum(elapsed), 'latency': _summary(elapsed)})
+    return results
+
+def bench_history(lengths, repeats):
+    """get_private_messages latency by history length, cold and warm."""
+    results = []
+    for length in lengths:
+        a, b = f"hist{length}_a", f"hist{length}_b"
+        auth.add_user(a, "password")
+        auth.add_user(b, "password")
+        for i in range(length):
+            chat.add_private_message(a, b, message_text=f"history message {i}")
+        cold, warm = [], []
+        for _ in range(repeats):
+            _reset_caches()
+            cold.append(_timed(chat.get_private_messages, a, b))
+            warm.append(_timed(chat.get_private_messages, a, b))
+        page = [_timed(chat.get_older_private_messages, a, b, limit=50) for _ in range(repeats)]
+        results.append({
+            'history_length': length,
+            'full_cold': _summary(cold),
+            'full_warm': _summary(warm),
+            'latest_page_warm': _summary(page),
+        })
+    return results
+
+def bench_users(counts, repeats):
+    """check_user, get_all_users and search_contacts latency by number of accounts."""
+    results = []
+    created = 0
+    for count in counts:
+        while created < count:
+            auth.add_user(f"dir{created:07d}", "password")
+            created += 1
+        name = f"dir{random.randrange(count):07d}"
+        results.append({
+            'users': count,
+            'check_user': _summary([_timed(auth.check_user, name, "password") for _ in range(repeats)]),
+            'get_all_users': _summary([_timed(auth.get_all_users, name) for _ in range(repeats)]),
+            'search_contacts_cold': _summary([
+                _timed(lambda: (contacts.invalidate_directory(), contacts.search_contacts(name, "dir00")))
+                for _ in range(repeats)
+            ]),
+        })
+    return results
+
+def bench_attachments(sizes_kb, repeats):
+    """Attachment encrypt/decrypt throughput by file size."""
+    key = crypto.generate_key()
+    results = []
+    for size_kb in sizes_kb:
+        data = os.urandom(size_kb * 1024)
+        path = os.path.join("uploads", f"bench_{size_kb}.enc")
+        os.makedirs("uploads", exist_ok=True)
+        encrypt = [_timed(crypto.encrypt_file, io.BytesIO(data), path, key) for _ in range(repeats)]
+        decrypt = [_timed(crypto.decrypt_file, path, key) for _ in range(repeats)]
+        megabytes = len(data) / (1024 * 1024)
+        results.append({
+            'size_kb': size_kb,
+            'encrypt_mb_per_s': megabytes / statistics.fmean(encrypt),
+            'decrypt_mb_per_s': megabytes / statistics.fmean(decrypt),
+            'encrypt': _summary(encrypt),
+            'decrypt': _summary(decrypt),
+        })
+    return results
+
+def bench_concurrent(threads, messages_per_thread):
+    """Simulates concurrent sessions that each send and then refresh their chat."""
+    names = [f"conc{i:03d}" for i in range(threads + 1)]
+    for name in names:
+        auth.add_user(name, "password")
+    send_latencies, read_latencies = [], []
+    lock = threading.Lock()
+
+    def session(index):
+        me, partner = names[index], names[(index + 1) % len(names)]
+        sends, reads = [], []
+        last_id = 0
+        for i in range(messages_per_thread):
+            sends.append(_timed(chat.add_private_message, me, partner, message_text=f"burst {i}"))
+            start = time.perf_counter()
+            new = chat.get_private_messages(me, partner, since_id=last_id)
+            reads.append(time.perf_counter() - start)
+            if new:
+                last_id = new[-1]['id']
+        with lock:
+            send_latencies.extend(sends)
+            read_latencies.extend(reads)
+
+    workers = [threading.Thread(target=session, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - start
+    return {
+        'threads': threads,
+        'messages': len(send_latencies),
+        'sends_per_second': len(send_latencies) / elapsed,
+        'send_latency': _summary(send_latencies),
+        'refresh_latency': _summary(read_latencies),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the chat data path.")
+    parser.add_argument("--users", type=int, default=50, help="users to seed")
+    parser.add_argument("--conversations", type=int, default=20, help="conversations to seed")
+    parser.add_argument("--messages", type=int, default=100, help="messages per seeded conversation and per sender")
+    parser.add_argument("--attachment-size-kb", type=int, default=64, help="size of seeded attachments (0 for none)")
+    parser.add_argument("--history-lengths", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--group-sizes", type=int, nargs="+", default=[2, 200])
+    parser.add_argument("--user-counts", type=int, nargs="+", default=[100, 1000])
+    parser.add_argument("--file-sizes-kb", type=int, nargs="+", default=[64, 1024, 16384])
+    parser.add_argument("--threads", type=int, default=0, help="also run the concurrent-sessions test")
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=1234, help="random seed")
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    output = os.path.abspath(args.output) if args.output else None
+    original_dir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="chatapp-bench-")
+    os.chdir(workdir)
+    database.close_all_connections()
+    # Bulk sends would otherwise be throttled; this measures the data path, not admission control.
+    limits.SEND_BURST_PER_USER = limits.SEND_BURST_PER_CONVERSATION = float('inf')
+    try:
+        database.ensure_schema()
+        results = {
+            'params': vars(args),
+            'environment': {
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+            },
+        }
+        start = time.perf_counter()
+        seed(args.users, args.conversations, args.messages, args.attachment_size_kb * 1024)
+        results['seed_seconds'] = time.perf_counter() - start
+        results['send'] = bench_send(args.messages)
+        results['group_send'] = bench_group_send(args.group_sizes, args.messages)
+        results['history'] = bench_history(args.history_lengths, args.repeats)
+        results['users'] = bench_users(args.user_counts, args.repeats)
+        results['attachments'] = bench_attachments(args.file_sizes_kb, max(1, args.repeats // 4))
+        if args.threads:
+            results['concurrent'] = bench_concurrent(args.threads, args.messages)
+        results['caches'] = {
+            'messages': chat.get_message_cache_stats(),
+            'attachments': attachments.get_attachment_cache_stats(),
+        }
+    finally:
+        database.close_all_connections()
+        os.chdir(original_dir)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = json.dumps(results, indent=2)
+    print(report)
+    if output:
+        with open(output, "w") as f:
+            f.write(report)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,97 @@
+# cache.py
+
+import threading
+from collections import OrderedDict
+
+class LRUCache:
+    """A small thread-safe least-recently-used cache.
+
+    Entries are evicted once there are more than max_items of them or, when
+    max_bytes is set, once the total of sizeof(value) goes over max_bytes.
+    on_evict(key, value) is called for entries pushed out by eviction.
+    Module-level instances are shared by every Streamlit session in the process.
+    """
+
+    def __init__(self, max_items=1024, max_bytes=None, sizeof=None, on_evict=None):
+        self.max_items = max_items
+        self.max_bytes = max_bytes
+        self._sizeof = sizeof or (lambda value: 0)
+        self._on_evict = on_evict
+        self._data = OrderedDict()  # key -> (value, size)
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """Returns the cached value for key and marks it as recently used."""
+        with self._lock:
+            if key not in self._data:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._data.move_to_end(key)
+            return self._data[key][0]
+
+    def put(self, key, value):
+        """Stores a value, evicting the least recently used entries if full.
+
+        Returns False if the value alone is bigger than max_bytes and was not stored.
+        """
+        size = self._sizeof(value)
+        evicted = []
+        with self._lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                return False  # Would push everything else out; not worth caching.
+            if key in self._data:
+                self.total_bytes -= self._data[key][1]
+            self._data[key] = (value, size)
+            self._data.move_to_end(key)
+            self.total_bytes += size
+            while len(self._data) > self.max_items or (
+                self.max_bytes is not None and self.total_bytes > self.max_bytes
+            ):
+                evicted_key, (evicted_value, evicted_size) = self._data.popitem(last=False)
+                self.total_bytes -= evicted_size
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_value))
+        if self._on_evict:
+            for evicted_key, evicted_value in evicted:
+                self._on_evict(evicted_key, evicted_value)
+        return True
+
+    def pop(self, key, default=None):
+        """Removes key from the cache and returns its value."""
+        with self._lock:
+            if key not in self._data:
+                return default
+            value, size = self._data.pop(key)
+            self.total_bytes -= size
+            return value
+
+    def discard_where(self, predicate):
+        """Removes every entry whose key matches predicate(key)."""
+        with self._lock:
+            for key in [k for k in self._data if predicate(k)]:
+                self.total_bytes -= self._data.pop(key)[1]
+
+    def clear(self):
+        """Removes every entry."""
+        with self._lock:
+            self._data.clear()
+            self.total_bytes = 0
+
+    def stats(self):
+        """Returns hit/miss/eviction counters and current usage."""
+        with self._lock:
+            return {
+                'entries': len(self._data),
+                'bytes': self.total_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._data)
@@ -4,87 +4,193 @@ import sqlite3
 from database import get_db_connection
 from crypto import (
     generate_key, 
-    encrypt_message, decrypt_message,
-    encrypt_bytes, decrypt_bytes
+    encrypt_message, decrypt_messages,
+    DECRYPTION_FAILED_TEXT
 )
-import os
-import uuid
+import sys
 from auth import hash_password # Import the hashing function
+from cache import LRUCache
+from metrics import instrument
+import limits
+import notify
+import writer
+from search import blind_tokens, store_tokens, find_message_ids
+from attachments import store_attachment, add_attachment_reference
+from archive import read_archived_after, read_archived_before, read_archived_ids
+from contacts import GROUP_PREFIX, is_group_handle, is_valid_group_name
 
+CONVERSATION_CACHE_SIZE = 4096  # Conversations whose id and key are kept in memory
+DECRYPTED_CACHE_MAX_BYTES = 32 * 1024 * 1024  # Memory budget for decrypted message text
 
-def get_or_create_shared_key(user1, user2):
-    """Gets the shared key for two users, creating one if it doesn't exist."""
-    users = sorted([user1, user2])
-    u1, u2 = users[0], users[1]
+# _conversation_pair(...) -> conversation dict from _load_conversation
+_conversation_cache = LRUCache(max_items=CONVERSATION_CACHE_SIZE)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
+# (conversation_id, message_id) -> decrypted text. Ciphertext never changes once
+# written, so both participants of a chat can share the same entries.
+_decrypted_cache = LRUCache(
+    max_items=sys.maxsize, max_bytes=DECRYPTED_CACHE_MAX_BYTES, sizeof=sys.getsizeof
+)
+
+
+def _load_conversation(cursor, u1, u2):
+    """Reads a conversation and every version of its key, or returns None if it does not exist."""
     cursor.execute(
-        "SELECT shared_key FROM conversations WHERE user1_username = ? AND user2_username = ?",
+        "SELECT id, shared_key, key_version FROM conversations WHERE user1_username = ? AND user2_username = ?",
         (u1, u2)
     )
     result = cursor.fetchone()
-    if result:
-        conn.close()
-        return result['shared_key']
-    else:
-        new_key = generate_key()
+    if result is None:
+        return None
+    cursor.execute(
+        "SELECT shared_key FROM conversation_keys WHERE conversation_id = ? ORDER BY version DESC",
+        (result['id'],)
+    )
+    keys = tuple(row['shared_key'] for row in cursor.fetchall()) or (result['shared_key'],)
+    return {
+        'id': result['id'],
+        'shared_key': result['shared_key'],  # Current key: all new writes use it
+        'key_version': result['key_version'],
+        'keys': keys,  # Every key version, newest first: reads accept any of them
+        'base_key': keys[-1],  # First key, which the search index and blob addresses derive from
+    }
+
+def _conversation_pair(user1, user2):
+    """Returns the (user1_username, user2_username) of a chat's row; a group's is (handle, handle)."""
+    for name in (user1, user2):
+        if is_group_handle(name):
+            return name, name
+    users = sorted([user1, user2])
+    return users[0], users[1]
+
+def _get_group_conversation(handle, username):
+    """Returns a group's conversation dict, or raises PermissionError if username is not a member."""
+    conversation = _conversation_cache.get((handle, handle))
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if conversation is None:
+            conversation = _load_conversation(cursor, handle, handle)
         cursor.execute(
-            "INSERT INTO conversations (user1_username, user2_username, shared_key) VALUES (?, ?, ?)",
-            (u1, u2, new_key)
+            "SELECT 1 FROM conversation_members WHERE conversation_id = ? AND username = ?",
+            (conversation['id'] if conversation else None, username)
         )
-        conn.commit()
-        conn.close()
-        return new_key
+        is_member = cursor.fetchone() is not None
+    # Unknown groups get the same error, so non-members cannot probe which names exist.
+    if not is_member:
+        raise PermissionError(f"{username} is not a member of {handle}")
+    _conversation_cache.put((handle, handle), conversation)
+    return conversation
+
+@instrument("chat.get_or_create_conversation")
+def get_or_create_conversation(user1, user2):
+    """Gets the conversation (id and keys) for two users, creating it if needed.
+
+    Either user may instead be a group handle ("#name"); the group must exist
+    and the other name must be one of its members.
+    """
+    if is_group_handle(user1) or is_group_handle(user2):
+        handle, member = (user1, user2) if is_group_handle(user1) else (user2, user1)
+        return _get_group_conversation(handle, member)
+    u1, u2 = _conversation_pair(user1, user2)
+
+    cached = _conversation_cache.get((u1, u2))
+    if cached:
+        return cached
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        conversation = _load_conversation(cursor, u1, u2)
+        if conversation is None:
+            new_key = generate_key()
+            # OR IGNORE: another session may have created the row since our SELECT.
+            cursor.execute(
+                "INSERT OR IGNORE INTO conversations (user1_username, user2_username, shared_key) VALUES (?, ?, ?)",
+                (u1, u2, new_key)
+            )
+            if cursor.rowcount:
+                cursor.execute(
+                    "INSERT INTO conversation_keys (conversation_id, version, shared_key) VALUES (?, 1, ?)",
+                    (cursor.lastrowid, new_key)
+                )
+            conn.commit()
+            conversation = _load_conversation(cursor, u1, u2)
+    _conversation_cache.put((u1, u2), conversation)
+    return conversation
+
+def invalidate_conversation(user1, user2):
+    """Drops the cached key and decrypted messages of a conversation, e.g. after its key changes."""
+    pair = _conversation_pair(user1, user2)
+    # Look the id up even if the key was already evicted; decrypted entries may outlive it.
+    conversation = _conversation_cache.pop(pair) or get_or_create_conversation(user1, user2)
+    _conversation_cache.pop(pair)
+    _decrypted_cache.discard_where(lambda k: k[0] == conversation['id'])
+
+def forget_decrypted_message(conversation_id, message_id):
+    """Drops one message from the decrypted-message cache, e.g. after it is deleted."""
+    _decrypted_cache.pop((conversation_id, message_id))
+
+def get_message_cache_stats():
+    """Returns hit/miss/eviction counters for the decrypted-message cache."""
+    return _decrypted_cache.stats()
+
+def get_or_create_shared_key(user1, user2):
+    """Gets the shared key for two users, creating one if it doesn't exist."""
+    return get_or_create_conversation(user1, user2)['shared_key']
+
+def get_conversation_keys(user1, user2):
+    """Returns every key version of a chat, newest first, for decrypting anything stored in it."""
+    return get_or_create_conversation(user1, user2)['keys']
 
 # --- ALL OF THE FOLLOWING FUNCTIONS ARE NEW ---
 
+def _pin_location(current_user, chat_partner):
+    """Returns (table, column, where clause, params) of the current user's PIN for a chat."""
+    if is_group_handle(chat_partner):
+        conversation = get_or_create_conversation(current_user, chat_partner)
+        return ("conversation_members", "pin", "conversation_id = ? AND username = ?",
+                (conversation['id'], current_user))
+    u1, u2 = _conversation_pair(current_user, chat_partner)
+    pin_column = "user1_pin" if current_user == u1 else "user2_pin"
+    return "conversations", pin_column, "user1_username = ? AND user2_username = ?", (u1, u2)
+
+@instrument("chat.set_chat_pin")
 def set_chat_pin(current_user, chat_partner, pin):
     """Sets or updates the PIN for the current user for a specific chat."""
-    users = sorted([current_user, chat_partner])
-    u1, u2 = users[0], users[1]
     hashed_pin = hash_password(pin)
-    
-    pin_column = "user1_pin" if current_user == u1 else "user2_pin"
+    table, pin_column, where, params = _pin_location(current_user, chat_partner)
+    u1, u2 = _conversation_pair(current_user, chat_partner)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = f"UPDATE conversations SET {pin_column} = ? WHERE user1_username = ? AND user2_username = ?"
-    cursor.execute(query, (hashed_pin, u1, u2))
-    conn.commit()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"UPDATE {table} SET {pin_column} = ? WHERE {where}", (hashed_pin, *params))
+        cursor.execute(
+            "UPDATE conversations SET version = version + 1 WHERE user1_username = ? AND user2_username = ?",
+            (u1, u2)
+        )
+        conn.commit()
 
+@instrument("chat.is_pin_set")
 def is_pin_set(current_user, chat_partner):
     """Checks if the current user has set a PIN for this chat."""
-    users = sorted([current_user, chat_partner])
-    u1, u2 = users[0], users[1]
-    
-    pin_column = "user1_pin" if current_user == u1 else "user2_pin"
-    
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = f"SELECT {pin_column} FROM conversations WHERE user1_username = ? AND user2_username = ?"
-    cursor.execute(query, (u1, u2))
-    result = cursor.fetchone()
-    conn.close()
+    table, pin_column, where, params = _pin_location(current_user, chat_partner)
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {pin_column} FROM {table} WHERE {where}", params)
+        result = cursor.fetchone()
 
     # If a conversation row exists and the PIN column is not NULL, a PIN is set.
     return result is not None and result[pin_column] is not None
 
+@instrument("chat.verify_chat_pin")
 def verify_chat_pin(current_user, chat_partner, submitted_pin):
     """Verifies the submitted PIN against the stored hashed PIN."""
-    users = sorted([current_user, chat_partner])
-    u1, u2 = users[0], users[1]
     hashed_submitted_pin = hash_password(submitted_pin)
-    
-    pin_column = "user1_pin" if current_user == u1 else "user2_pin"
+    table, pin_column, where, params = _pin_location(current_user, chat_partner)
 
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = f"SELECT {pin_column} FROM conversations WHERE user1_username = ? AND user2_username = ?"
-    cursor.execute(query, (u1, u2))
-    result = cursor.fetchone()
-    conn.close()
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT {pin_column} FROM {table} WHERE {where}", params)
+        result = cursor.fetchone()
     
     if result and result[pin_column]:
         return result[pin_column] == hashed_submitted_pin
@@ -93,71 +199,374 @@ def verify_chat_pin(current_user, chat_partner, submitted_pin):
 # --- END OF NEW FUNCTIONS ---
 
 
+@instrument("chat.get_conversation_version")
+def get_conversation_version(user1, user2):
+    """Returns a counter that changes whenever a message is added, a PIN is set or the key is rotated.
+
+    Callers can compare it with the value they saw last time and skip reloading
+    anything when it is unchanged. If another process has rotated the key, the
+    cached keys are dropped here so the next read picks up the new one.
+    """
+    conversation = get_or_create_conversation(user1, user2)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT version, key_version FROM conversations WHERE id = ?", (conversation['id'],))
+        row = cursor.fetchone()
+    if row['key_version'] != conversation['key_version']:
+        _conversation_cache.pop(_conversation_pair(user1, user2))
+    return row['version']
+
+
+def _insert_message(cursor, conversation_id, sender, receiver, message_type,
+                    encrypted_message=None, encrypted_file_path=None, original_filename=None,
+                    file_size=None, search_tokens=(), key_version=1, group=False):
+    """Write-queue job: inserts one message and updates the conversation version, summaries and search index.
+
+    A group message is stored once for every member; only the sender's read
+    position moves, so the cost does not depend on the size of the group.
+    """
+    cursor.execute(
+        """
+        INSERT INTO messages (conversation_id, sender_username, receiver_username, message_type,
+                              encrypted_message, encrypted_file_path, original_filename, key_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        (conversation_id, sender, receiver, message_type,
+         encrypted_message, encrypted_file_path, original_filename, key_version)
+    )
+    message_id = cursor.lastrowid
+    # Bumped in the same transaction so readers never see the new version without the message.
+    cursor.execute(
+        "UPDATE conversations SET version = version + 1, last_message_id = ? WHERE id = ?",
+        (message_id, conversation_id)
+    )
+    if group:
+        cursor.execute(
+            "UPDATE conversation_members SET last_read_id = ? WHERE conversation_id = ? AND username = ?",
+            (message_id, conversation_id, sender)
+        )
+    else:
+        for username, partner, unread in ((sender, receiver, 0), (receiver, sender, 1)):
+            cursor.execute(
+                """
+                INSERT INTO conversation_summary
+                    (username, conversation_id, partner_username, last_message_id, last_timestamp, unread_count)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?)
+                ON CONFLICT (username, conversation_id) DO UPDATE SET
+                    last_message_id = excluded.last_message_id,
+                    last_timestamp = excluded.last_timestamp,
+                    unread_count = unread_count + excluded.unread_count
+                """,
+                (username, conversation_id, partner, message_id, unread)
+            )
+    if encrypted_file_path:
+        add_attachment_reference(cursor, encrypted_file_path, conversation_id, file_size, key_version)
+    store_tokens(cursor, conversation_id, message_id, search_tokens)
+    return message_id
+
+
+@instrument("chat.add_private_message")
 def add_private_message(sender, receiver, message_text=None, uploaded_file=None):
-    # (This function remains unchanged)
-    key = get_or_create_shared_key(sender, receiver)
-    conn = get_db_connection()
-    cursor = conn.cursor()
+    """Encrypts and stores a text message or file; returns the new message id once it is committed.
+
+    receiver may be a group handle, in which case every member sees the message.
+    Raises limits.RateLimitExceeded if the sender or the chat is over its send
+    rate, or the upload does not fit in the upload budget.
+    """
+    if not message_text and not uploaded_file:
+        return None
+    conversation = get_or_create_conversation(sender, receiver)
+    key = conversation['shared_key']
+    key_version = conversation['key_version']
+    group = is_group_handle(receiver)
 
+    # Encryption happens here, in the caller's thread; only the INSERT goes through the write queue.
+    # Limits are checked before any encryption or disk work, so rejected requests stay cheap.
     if message_text:
+        limits.admit_send(sender, conversation['id'])
         encrypted_text = encrypt_message(message_text, key)
+        tokens = blind_tokens(message_text, conversation['base_key'])
+        job = lambda cursor: _insert_message(
+            cursor, conversation['id'], sender, receiver, 'text', encrypted_message=encrypted_text,
+            search_tokens=tokens, key_version=key_version, group=group
+        )
+    else:
+        # Size and byte budget first, so a refused file does not use up send tokens.
+        with limits.upload_budget(limits.upload_size(uploaded_file)):
+            limits.admit_send(sender, conversation['id'])
+            encrypted_file_path, file_size = store_attachment(uploaded_file, key, address_key=conversation['base_key'])
+        file_type = uploaded_file.type.split('/')[0]
+        message_type = 'image' if file_type == 'image' else 'file'
+        tokens = blind_tokens(uploaded_file.name, conversation['base_key'])
+        job = lambda cursor: _insert_message(
+            cursor, conversation['id'], sender, receiver, message_type,
+            encrypted_file_path=encrypted_file_path, original_filename=uploaded_file.name,
+            file_size=file_size, search_tokens=tokens, key_version=key_version, group=group
+        )
+
+    message_id = writer.run(job)
+    notify.publish(conversation['id'], message_id)
+    return message_id
+
+
+@instrument("chat.mark_conversation_read")
+def mark_conversation_read(username, partner):
+    """Resets the user's unread count for a chat, e.g. when they open it."""
+    conversation = get_or_create_conversation(username, partner)
+    if is_group_handle(partner):
+        writer.run(lambda cursor: cursor.execute(
+            "UPDATE conversation_members SET last_read_id = "
+            "(SELECT COALESCE(last_message_id, 0) FROM conversations WHERE id = ?) "
+            "WHERE conversation_id = ? AND username = ?",
+            (conversation['id'], conversation['id'], username)
+        ))
+        return
+    writer.run(lambda cursor: cursor.execute(
+        "UPDATE conversation_summary SET unread_count = 0 "
+        "WHERE username = ? AND conversation_id = ? AND unread_count > 0",
+        (username, conversation['id'])
+    ))
+
+
+@instrument("chat.get_conversation_summaries")
+def get_conversation_summaries(username, limit=50):
+    """Returns the user's chats, most recently active first, with their unread counts.
+
+    Groups are included, with their handle as partner_username.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
         cursor.execute(
             """
-            INSERT INTO messages (sender_username, receiver_username, message_type, encrypted_message) 
-            VALUES (?, ?, ?, ?)
+            SELECT partner_username, last_message_id, last_timestamp, unread_count
+            FROM conversation_summary
+            WHERE username = ?
+            ORDER BY last_message_id DESC
+            LIMIT ?
             """,
-            (sender, receiver, 'text', encrypted_text)
+            (username, limit)
         )
-    
-    elif uploaded_file:
-        uploads_dir = "uploads"
-        os.makedirs(uploads_dir, exist_ok=True)
-        encrypted_filename = f"{uuid.uuid4().hex}.enc"
-        encrypted_file_path = os.path.join(uploads_dir, encrypted_filename)
-        file_bytes = uploaded_file.read()
-        encrypted_bytes = encrypt_bytes(file_bytes, key)
-        with open(encrypted_file_path, "wb") as f:
-            f.write(encrypted_bytes)
-        file_type = uploaded_file.type.split('/')[0]
-        message_type = 'image' if file_type == 'image' else 'file'
+        summaries = [dict(row) for row in cursor.fetchall()]
+        # A group's unread count is a range count on idx_messages_conversation past the member's read position.
         cursor.execute(
             """
-            INSERT INTO messages (sender_username, receiver_username, message_type, 
-                                  encrypted_file_path, original_filename) 
-            VALUES (?, ?, ?, ?, ?)
+            SELECT c.user1_username AS partner_username, c.last_message_id, m.timestamp AS last_timestamp,
+                   (SELECT COUNT(*) FROM messages
+                    WHERE conversation_id = c.id AND id > cm.last_read_id) AS unread_count
+            FROM conversation_members cm
+            JOIN conversations c ON c.id = cm.conversation_id
+            LEFT JOIN messages m ON m.id = c.last_message_id
+            WHERE cm.username = ?
+            ORDER BY c.last_message_id DESC
+            LIMIT ?
             """,
-            (sender, receiver, message_type, encrypted_file_path, uploaded_file.name)
+            (username, limit)
+        )
+        summaries.extend(dict(row) for row in cursor.fetchall())
+    summaries.sort(key=lambda summary: summary['last_message_id'] or 0, reverse=True)
+    return summaries[:limit]
+
+
+# --- Group conversations ---
+@instrument("chat.create_group")
+def create_group(name, creator, members=()):
+    """Creates a group chat and returns its handle ("#name"), or None if the name is taken or invalid.
+
+    The group has one shared key, like a direct chat, and every message is
+    encrypted and stored once for all members. Names in members that are not
+    registered users are skipped.
+    """
+    name = name.strip().lstrip(GROUP_PREFIX)
+    if not is_valid_group_name(name):
+        return None
+    handle = GROUP_PREFIX + name
+    new_key = generate_key()
+    usernames = sorted({creator, *members})
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT OR IGNORE INTO conversations (user1_username, user2_username, shared_key, group_name) "
+            "VALUES (?, ?, ?, ?)",
+            (handle, handle, new_key, name)
+        )
+        if not cursor.rowcount:
+            return None
+        conversation_id = cursor.lastrowid
+        cursor.execute(
+            "INSERT INTO conversation_keys (conversation_id, version, shared_key) VALUES (?, 1, ?)",
+            (conversation_id, new_key)
         )
+        placeholders = ", ".join("?" * len(usernames))
+        cursor.execute(
+            f"INSERT INTO conversation_members (conversation_id, username) "
+            f"SELECT ?, username FROM users WHERE username IN ({placeholders})",
+            (conversation_id, *usernames)
+        )
+        conn.commit()
+    return handle
+
+@instrument("chat.add_group_members")
+def add_group_members(handle, added_by, usernames):
+    """Adds registered users to a group that added_by belongs to; returns how many were new.
 
-    conn.commit()
-    conn.close()
+    New members start with nothing unread, but can scroll back through the
+    whole history.
+    """
+    conversation = get_or_create_conversation(added_by, handle)
+    usernames = sorted(set(usernames))
+    if not usernames:
+        return 0
 
+    def job(cursor):
+        placeholders = ", ".join("?" * len(usernames))
+        cursor.execute(
+            f"""
+            INSERT OR IGNORE INTO conversation_members (conversation_id, username, last_read_id)
+            SELECT c.id, u.username, COALESCE(c.last_message_id, 0)
+            FROM users u JOIN conversations c ON c.id = ?
+            WHERE u.username IN ({placeholders})
+            """,
+            (conversation['id'], *usernames)
+        )
+        added = cursor.rowcount
+        cursor.execute("UPDATE conversations SET version = version + 1 WHERE id = ?", (conversation['id'],))
+        return added
+    return writer.run(job)
 
-def get_private_messages(user1, user2):
-    # (This function remains unchanged)
-    key = get_or_create_shared_key(user1, user2)
-    conn = get_db_connection()
-    cursor = conn.cursor()
-    query = """
-        SELECT * FROM messages
-        WHERE (sender_username = ? AND receiver_username = ?)
-           OR (sender_username = ? AND receiver_username = ?)
-        ORDER BY timestamp ASC
+@instrument("chat.leave_group")
+def leave_group(handle, username):
+    """Removes username from a group.
+
+    The member keeps whatever they already decrypted. Rotating the group key
+    (rekey.rotate_conversation_key) keeps the content of later messages out of
+    reach of a copy of the old keys, but not their search tokens or attachment
+    addresses: those come from the first key, so someone holding it can still
+    check guessed words and known files against new messages.
     """
-    cursor.execute(query, (user1, user2, user2, user1))
-    messages = cursor.fetchall()
-    conn.close()
+    conversation = get_or_create_conversation(username, handle)
+
+    def job(cursor):
+        cursor.execute(
+            "DELETE FROM conversation_members WHERE conversation_id = ? AND username = ?",
+            (conversation['id'], username)
+        )
+        cursor.execute("UPDATE conversations SET version = version + 1 WHERE id = ?", (conversation['id'],))
+    writer.run(job)
+
+@instrument("chat.get_group_members")
+def get_group_members(handle, username):
+    """Returns the sorted usernames of a group's members; username must be one of them."""
+    conversation = get_or_create_conversation(username, handle)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT username FROM conversation_members WHERE conversation_id = ? ORDER BY username",
+            (conversation['id'],)
+        )
+        return [row['username'] for row in cursor.fetchall()]
+
+
+def _process_messages(messages, conversation):
+    """Decrypts fetched message rows into the dicts used by the UI."""
     processed_msgs = []
+    to_decrypt = []  # (msg_data, cache_key, ciphertext) of texts not in the cache
     for msg in messages:
         msg_data = {
+            'id': msg['id'],
             'sender_username': msg['sender_username'],
             'timestamp': msg['timestamp'],
             'message_type': msg['message_type']
         }
         if msg['message_type'] == 'text':
-            msg_data['message'] = decrypt_message(msg['encrypted_message'], key)
+            cache_key = (conversation['id'], msg['id'])
+            text = _decrypted_cache.get(cache_key)
+            if text is None:
+                to_decrypt.append((msg_data, cache_key, msg['encrypted_message']))
+            msg_data['message'] = text
         else:
             msg_data['file_path'] = msg['encrypted_file_path']
             msg_data['filename'] = msg['original_filename']
         processed_msgs.append(msg_data)
-    return processed_msgs
\ No newline at end of file
+
+    texts = decrypt_messages([ciphertext for _, _, ciphertext in to_decrypt], conversation['keys'])
+    for (msg_data, cache_key, _), text in zip(to_decrypt, texts):
+        msg_data['message'] = text
+        if text != DECRYPTION_FAILED_TEXT:
+            _decrypted_cache.put(cache_key, text)
+    return processed_msgs
+
+
+@instrument("chat.get_private_messages")
+def get_private_messages(user1, user2, since_id=0):
+    """Returns the messages between two users with an id greater than since_id.
+
+    Pass the id of the last message you already have to fetch only the new ones.
+    Archived messages are included when since_id reaches back into the archive.
+    """
+    conversation = get_or_create_conversation(user1, user2)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            SELECT * FROM messages
+            WHERE conversation_id = ? AND id > ?
+            ORDER BY id ASC
+        """
+        cursor.execute(query, (conversation['id'], since_id))
+        messages = cursor.fetchall()
+    archived = read_archived_after(conversation['id'], conversation['keys'], since_id)
+    return _process_messages(archived + messages, conversation)
+
+
+@instrument("chat.get_older_private_messages")
+def get_older_private_messages(user1, user2, before_id=None, limit=50):
+    """Returns up to `limit` messages older than before_id, oldest first.
+
+    With before_id=None the most recent page of the conversation is returned.
+    The archive is only read once the live messages run out.
+    """
+    conversation = get_or_create_conversation(user1, user2)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        query = """
+            SELECT * FROM messages
+            WHERE conversation_id = ? AND id < ?
+            ORDER BY id DESC
+            LIMIT ?
+        """
+        if before_id is None:
+            before_id = sys.maxsize
+        cursor.execute(query, (conversation['id'], before_id, limit))
+        messages = cursor.fetchall()
+    messages.reverse()
+    if len(messages) < limit:
+        # Archived ids are all lower than live ones, so the rest comes from the archive.
+        bound = messages[0]['id'] if messages else before_id
+        messages = read_archived_before(
+            conversation['id'], conversation['keys'], bound, limit - len(messages)
+        ) + messages
+    return _process_messages(messages, conversation)
+
+
+@instrument("chat.search_private_messages")
+def search_private_messages(user1, user2, query, limit=50):
+    """Returns the newest messages containing every word of query, oldest first.
+
+    Matching happens on the blind index, so only the matching messages are decrypted.
+    """
+    conversation = get_or_create_conversation(user1, user2)
+    message_ids = find_message_ids(conversation['id'], query, conversation['base_key'], limit)
+    if not message_ids:
+        return []
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        placeholders = ", ".join("?" * len(message_ids))
+        cursor.execute(
+            f"SELECT * FROM messages WHERE conversation_id = ? AND id IN ({placeholders}) ORDER BY id ASC",
+            (conversation['id'], *message_ids)
+        )
+        messages = cursor.fetchall()
+    if len(messages) < len(message_ids):
+        found = {msg['id'] for msg in messages}
+        missing = [message_id for message_id in message_ids if message_id not in found]
+        messages = read_archived_ids(conversation['id'], conversation['keys'], missing) + messages
+    return _process_messages(messages, conversation)
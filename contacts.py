@@ -0,0 +1,77 @@
+# contacts.py
+
+import re
+import sqlite3
+from cache import LRUCache
+from database import get_db_connection
+from metrics import instrument
+
+CONTACT_PAGE_SIZE = 25  # Contacts shown per page in the sidebar
+GROUP_PREFIX = "#"      # Group chats are addressed as "#name"; usernames may not start with it
+GROUP_NAME_RE = re.compile(r"[\w.-]{1,32}")  # Letters, digits, "_", "." and "-" only
+
+# (newest user id, query, substring, after, limit) -> usernames. Shared by
+# every session. Accounts are never deleted or renamed, so the newest user id
+# changes exactly when the directory does, in this process or any other one
+# sharing the database; stale pages are then never looked up again.
+_directory_cache = LRUCache(max_items=1024)
+
+@instrument("contacts.search_contacts")
+def search_contacts(current_username, query="", after=None, limit=CONTACT_PAGE_SIZE, substring=False):
+    """Returns one page of usernames matching query, sorted, and whether there is another page.
+
+    Pages are keyset-paginated: pass the last username of a page as `after` to
+    get the next one. Prefix matches are a range scan on the users.username
+    index; substring=True matches anywhere in the name and scans that index.
+    """
+    cache_key = (_newest_user_id(), query, substring, after, limit)
+    usernames = _directory_cache.get(cache_key)
+    if usernames is None:
+        usernames = _query_directory(query, after, limit + 2, substring)
+        _directory_cache.put(cache_key, usernames)
+    # Fetched two extra rows: one may be the current user, one tells us if there is a next page.
+    page = [name for name in usernames if name != current_username]
+    return page[:limit], len(page) > limit
+
+def is_group_handle(name):
+    """Tells whether a chat name refers to a group rather than a user."""
+    return name.startswith(GROUP_PREFIX)
+
+def is_valid_group_name(name):
+    """Tells whether name (without the prefix) may be used for a new group."""
+    return GROUP_NAME_RE.fullmatch(name) is not None
+
+def _newest_user_id():
+    """Returns the highest users.id, a single lookup at the end of the primary key."""
+    with get_db_connection() as conn:
+        try:
+            return conn.execute("SELECT MAX(id) FROM users").fetchone()[0] or 0
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return None
+
+def _query_directory(query, after, limit, substring):
+    conditions, params = [], []
+    if after is not None:
+        conditions.append("username > ?")
+        params.append(after)
+    if query and substring:
+        conditions.append("instr(username, ?) > 0")
+        params.append(query)
+    elif query:
+        # Everything that starts with query sorts between query and query + the highest code point.
+        conditions.append("username >= ? AND username < ?")
+        params.extend([query, query + "\U0010ffff"])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    with get_db_connection() as conn:
+        try:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT username FROM users {where} ORDER BY username LIMIT ?", (*params, limit))
+            return [row['username'] for row in cursor.fetchall()]
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return []
+
+def invalidate_directory():
+    """Drops every cached page, e.g. after a new account is created."""
+    _directory_cache.clear()
@@ -1,42 +1,254 @@
 # crypto.py
 
-from cryptography.fernet import Fernet
+import base64
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from metrics import instrument
+
+# The cryptography package is imported inside the functions that use it. It
+# takes tens of milliseconds to load, and pages like the login screen never
+# encrypt anything, so the cost is only paid the first time it is needed.
+
+FERNET_CACHE_SIZE = 1024  # Pre-built Fernet objects kept around, one per key
+
+# Batches smaller than this are decrypted serially; thread hand-off would cost more than it saves.
+PARALLEL_DECRYPT_MIN_BATCH = 64
+DECRYPT_WORKERS = min(8, os.cpu_count() or 1)
+
+# --- Chunked container for attachments ---
+# header: magic | version | chunk size | nonce prefix, followed by one AES-GCM
+# segment (chunk + 16-byte tag) per chunk. Each segment nonce is the prefix, the
+# segment index and a "last segment" flag, so reordered, dropped or truncated
+# segments fail authentication. Legacy .enc files are a single Fernet token,
+# which always starts with "gAAAAA", so they can never match the magic.
+STREAM_MAGIC = b"CENC"
+STREAM_VERSION = 1
+STREAM_CHUNK_SIZE = 64 * 1024
+_STREAM_HEADER = struct.Struct(">4sBI7s")
+_STREAM_TAG_SIZE = 16
+
+DECRYPTION_FAILED_TEXT = "⚠️ This message could not be decrypted."
 
 def generate_key():
     """Generates a new encryption key."""
+    from cryptography.fernet import Fernet
     return Fernet.generate_key()
 
+def _keys(key):
+    """Normalises one key or a tuple of key versions (newest first) to a tuple."""
+    return key if isinstance(key, tuple) else (key,)
+
+@lru_cache(maxsize=FERNET_CACHE_SIZE)
+def get_fernet(key):
+    """Returns a Fernet object for the key, reusing one built earlier when possible.
+
+    A tuple of keys, newest first, gives a MultiFernet that encrypts with the
+    first key and decrypts with any of them, so data written before a key
+    rotation stays readable.
+    """
+    from cryptography.fernet import Fernet, MultiFernet
+    if isinstance(key, tuple):
+        return MultiFernet([Fernet(k) for k in key])
+    return Fernet(key)
+
 # --- For Text ---
+@instrument("crypto.encrypt_message", bytes_from=lambda result, message, key: len(result))
 def encrypt_message(message, key):
     """Encrypts a text message using the provided key."""
-    f = Fernet(key)
+    f = get_fernet(key)
     encrypted_message = f.encrypt(message.encode())
     return encrypted_message
 
+@instrument("crypto.decrypt_message", bytes_from=lambda result, token, key: len(token))
 def decrypt_message(encrypted_message, key):
     """Decrypts a text message using the provided key."""
-    f = Fernet(key)
+    f = get_fernet(key)
     try:
         decrypted_message = f.decrypt(encrypted_message).decode()
         return decrypted_message
     except Exception as e:
         print(f"Decryption failed: {e}")
-        return "⚠️ This message could not be decrypted."
+        return DECRYPTION_FAILED_TEXT
 
 # --- THIS IS NEW (For Files) ---
+# encrypt_bytes/decrypt_bytes work on whole files in memory. New attachments use
+# the streaming functions further down; decrypt_bytes is kept for old .enc files.
+@instrument("crypto.encrypt_bytes", bytes_from=lambda result, data, key: len(data))
 def encrypt_bytes(data_bytes, key):
     """Encrypts raw bytes using the provided key."""
-    f = Fernet(key)
+    f = get_fernet(key)
     encrypted_bytes = f.encrypt(data_bytes)
     return encrypted_bytes
 
+@instrument("crypto.decrypt_bytes", bytes_from=lambda result, data, key: len(data))
 def decrypt_bytes(encrypted_bytes, key):
     """Decrypts raw bytes using the provided key."""
-    f = Fernet(key)
+    f = get_fernet(key)
     try:
         decrypted_bytes = f.decrypt(encrypted_bytes)
         return decrypted_bytes
     except Exception as e:
         print(f"File decryption failed: {e}")
         return None
-# --- END OF NEW ---
\ No newline at end of file
+# --- END OF NEW ---
+
+# --- Streaming (For Large Files) ---
+@lru_cache(maxsize=FERNET_CACHE_SIZE)
+def _get_stream_cipher(key):
+    """Derives the AES-GCM cipher used for chunked files from a Fernet key."""
+    from cryptography.hazmat.primitives import hashes
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+    stream_key = HKDF(
+        algorithm=hashes.SHA256(), length=32, salt=None, info=b"chatapp attachment stream"
+    ).derive(base64.urlsafe_b64decode(key))
+    return AESGCM(stream_key)
+
+def _segment_nonce(prefix, index, is_last):
+    return prefix + struct.pack(">IB", index, 1 if is_last else 0)
+
+def encrypt_stream(source, key, chunk_size=STREAM_CHUNK_SIZE):
+    """Encrypts a readable file object chunk by chunk, yielding the encrypted container.
+
+    Only two chunks are held in memory at a time, whatever the size of the file.
+    """
+    cipher = _get_stream_cipher(_keys(key)[0])
+    prefix = os.urandom(7)
+    header = _STREAM_HEADER.pack(STREAM_MAGIC, STREAM_VERSION, chunk_size, prefix)
+    yield header
+    index = 0
+    chunk = source.read(chunk_size)
+    while True:
+        next_chunk = source.read(chunk_size)
+        is_last = not next_chunk
+        yield cipher.encrypt(_segment_nonce(prefix, index, is_last), chunk, header)
+        if is_last:
+            break
+        chunk = next_chunk
+        index += 1
+
+def decrypt_stream(source, key):
+    """Decrypts a readable encrypted file object, yielding plaintext chunks as they are verified.
+
+    Old single-token .enc files are decrypted in one piece. key may be a tuple
+    of key versions; the first segment picks the one the file was written with.
+    Raises InvalidToken if the data has been tampered with, is truncated or no
+    key matches.
+    """
+    from cryptography.exceptions import InvalidTag
+    from cryptography.fernet import InvalidToken
+    header = source.read(_STREAM_HEADER.size)
+    if not header.startswith(STREAM_MAGIC):
+        yield get_fernet(key).decrypt(header + source.read())
+        return
+    if len(header) < _STREAM_HEADER.size:
+        raise InvalidToken
+    _, version, chunk_size, prefix = _STREAM_HEADER.unpack(header)
+    if version != STREAM_VERSION:
+        raise InvalidToken
+    segment_size = chunk_size + _STREAM_TAG_SIZE
+    index = 0
+    segment = source.read(segment_size)
+    cipher = None
+    while True:
+        next_segment = source.read(segment_size)
+        is_last = not next_segment
+        nonce = _segment_nonce(prefix, index, is_last)
+        if cipher is None:
+            for candidate in map(_get_stream_cipher, _keys(key)):
+                try:
+                    chunk = candidate.decrypt(nonce, segment, header)
+                except InvalidTag:
+                    continue
+                cipher = candidate
+                break
+            else:
+                raise InvalidToken
+        else:
+            try:
+                chunk = cipher.decrypt(nonce, segment, header)
+            except InvalidTag:
+                raise InvalidToken from None
+        yield chunk
+        if is_last:
+            break
+        segment = next_segment
+        index += 1
+
+@instrument("crypto.encrypt_file", bytes_from=lambda result, source, path, key: os.path.getsize(path))
+def encrypt_file(source, dest_path, key):
+    """Streams a readable file object into an encrypted file at dest_path."""
+    temp_path = f"{dest_path}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            for block in encrypt_stream(source, key):
+                f.write(block)
+        os.replace(temp_path, dest_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+def iter_decrypt_file(path, key):
+    """Yields the decrypted contents of an encrypted file chunk by chunk."""
+    with open(path, "rb") as f:
+        yield from decrypt_stream(f, key)
+
+@instrument("crypto.decrypt_file", bytes_from=lambda result, path, key: len(result or b""))
+def decrypt_file(path, key):
+    """Decrypts a whole encrypted file (chunked or legacy) into bytes, or None on failure."""
+    from cryptography.fernet import InvalidToken
+    try:
+        return b"".join(iter_decrypt_file(path, key))
+    except InvalidToken as e:
+        print(f"File decryption failed: {e!r}")
+        return None
+
+# --- Batches (For History and Galleries) ---
+_executor = None
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DECRYPT_WORKERS, thread_name_prefix="chat-decrypt")
+    return _executor
+
+def _split(items, parts):
+    size = -(-len(items) // parts)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+@instrument("crypto.decrypt_messages")
+def decrypt_messages(encrypted_messages, key):
+    """Decrypts many text messages with one key, keeping their order.
+
+    Large batches are split across a bounded thread pool. A message that fails
+    to decrypt comes back as DECRYPTION_FAILED_TEXT, exactly like decrypt_message.
+    """
+    encrypted_messages = list(encrypted_messages)
+    if len(encrypted_messages) < PARALLEL_DECRYPT_MIN_BATCH or DECRYPT_WORKERS < 2:
+        return [decrypt_message(token, key) for token in encrypted_messages]
+    # One slice per worker keeps the per-task overhead to a handful of hand-offs.
+    slices = _get_executor().map(
+        lambda tokens: [decrypt_message(token, key) for token in tokens],
+        _split(encrypted_messages, DECRYPT_WORKERS)
+    )
+    return [text for texts in slices for text in texts]
+
+@instrument("crypto.decrypt_files")
+def decrypt_files(paths, key):
+    """Decrypts several encrypted files in parallel, keeping their order.
+
+    Each result is what decrypt_file would return, or FileNotFoundError if the
+    file is missing, so one bad file does not fail the rest.
+    """
+    def safe_decrypt(path):
+        try:
+            return decrypt_file(path, key)
+        except FileNotFoundError as e:
+            return e
+    paths = list(paths)
+    if len(paths) < 2 or DECRYPT_WORKERS < 2:
+        return [safe_decrypt(path) for path in paths]
+    return list(_get_executor().map(safe_decrypt, paths))
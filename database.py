@@ -1,19 +1,74 @@
 # database.py
 
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
+from metrics import instrument
 
-def get_db_connection():
-    """Establishes a connection to the SQLite database."""
-    conn = sqlite3.connect('chat_app.db')
+DB_PATH = 'chat_app.db'
+
+# Connection settings applied to every pooled connection.
+POOL_SIZE = 8             # Idle connections kept open for reuse
+BUSY_TIMEOUT_MS = 5000    # How long to wait on a locked database before failing
+CACHE_SIZE_KB = 16384     # Page cache per connection (16 MB)
+
+BACKFILL_BATCH_SIZE = 1000  # Rows updated per transaction by data migrations
+
+_pool = queue.LifoQueue(maxsize=POOL_SIZE)
+
+@instrument("database.connect")
+def _connect():
+    """Opens a new SQLite connection configured for concurrent access."""
+    conn = sqlite3.connect(DB_PATH, timeout=BUSY_TIMEOUT_MS / 1000, check_same_thread=False)
     conn.row_factory = sqlite3.Row
+    # WAL lets readers and a writer work at the same time instead of blocking each other.
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+    conn.execute(f"PRAGMA cache_size=-{CACHE_SIZE_KB}")
     return conn
 
-def create_tables():
-    """Creates the necessary tables for users, messages, and conversation keys."""
-    conn = get_db_connection()
+@contextmanager
+def get_db_connection():
+    """Borrows a connection from the pool and returns it when the block exits.
+
+    Anything not committed inside the block is rolled back before the
+    connection goes back to the pool.
+    """
     try:
+        conn = _pool.get_nowait()
+    except queue.Empty:
+        conn = _connect()
+    try:
+        yield conn
+    finally:
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            _pool.put_nowait(conn)
+        except (queue.Full, sqlite3.Error):
+            conn.close()
+
+def close_all_connections():
+    """Closes every idle connection in the pool."""
+    while True:
+        try:
+            _pool.get_nowait().close()
+        except queue.Empty:
+            break
+
+@instrument("database.create_tables")
+def create_tables():
+    """Creates the necessary tables for users, messages, and conversation keys.
+
+    This is schema version 1: everything the app needed before versioning
+    existed. Every step is idempotent, so it also upgrades databases created
+    by older releases. Prefer ensure_schema(), which runs it only once.
+    """
+    with get_db_connection() as conn:
         cursor = conn.cursor()
-        
+    
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS users (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -21,24 +76,27 @@ def create_tables():
                 password TEXT NOT NULL
             );
         """)
-        
+    
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS messages (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
                 sender_username TEXT NOT NULL,
                 receiver_username TEXT NOT NULL,
                 timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                
+            
                 message_type TEXT NOT NULL DEFAULT 'text', 
                 encrypted_message TEXT,
                 encrypted_file_path TEXT,
                 original_filename TEXT,
+                conversation_id INTEGER,
+                key_version INTEGER NOT NULL DEFAULT 1,
 
                 FOREIGN KEY (sender_username) REFERENCES users (username),
-                FOREIGN KEY (receiver_username) REFERENCES users (username)
+                FOREIGN KEY (receiver_username) REFERENCES users (username),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
             );
         """)
-        
+    
         # --- THIS IS THE CHANGE ---
         cursor.execute("""
             CREATE TABLE IF NOT EXISTS conversations (
@@ -48,17 +106,283 @@ def create_tables():
                 shared_key BLOB NOT NULL,
                 user1_pin TEXT, -- Can be NULL
                 user2_pin TEXT, -- Can be NULL
+                version INTEGER NOT NULL DEFAULT 0, -- Bumped on every change to the chat
+                last_message_id INTEGER,
+                key_version INTEGER NOT NULL DEFAULT 1, -- Version of shared_key in conversation_keys
                 UNIQUE (user1_username, user2_username)
             );
         """)
         # --- END OF CHANGE ---
-        
+
+        # Databases created before conversation_id existed get the column added here.
+        _add_column_if_missing(cursor, "messages", "conversation_id",
+                               "INTEGER REFERENCES conversations (id)")
+        _add_column_if_missing(cursor, "conversations", "version", "INTEGER NOT NULL DEFAULT 0")
+        _add_column_if_missing(cursor, "conversations", "last_message_id", "INTEGER")
+        _add_column_if_missing(cursor, "conversations", "key_version", "INTEGER NOT NULL DEFAULT 1")
+        _add_column_if_missing(cursor, "messages", "key_version", "INTEGER NOT NULL DEFAULT 1")
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_messages_conversation
+            ON messages (conversation_id, id)
+        """)
+
+        # One row per user per chat, kept up to date as messages are added,
+        # so the sidebar can show recent chats and unread counts in one query.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_summary (
+                username TEXT NOT NULL,
+                conversation_id INTEGER NOT NULL,
+                partner_username TEXT NOT NULL,
+                last_message_id INTEGER,
+                last_timestamp DATETIME,
+                unread_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (username, conversation_id),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+            );
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conversation_summary_recent
+            ON conversation_summary (username, last_message_id DESC)
+        """)
+
+        # Blind keyword index: keyed-HMAC digests of each message's words (see search.py).
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS message_search_tokens (
+                conversation_id INTEGER NOT NULL,
+                token BLOB NOT NULL,
+                message_id INTEGER NOT NULL,
+                PRIMARY KEY (conversation_id, token, message_id)
+            ) WITHOUT ROWID;
+        """)
+
+        # One row per stored attachment blob; refcount is the number of messages using it.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS attachment_blobs (
+                path TEXT PRIMARY KEY,
+                conversation_id INTEGER,
+                size INTEGER,
+                refcount INTEGER NOT NULL DEFAULT 0,
+                key_version INTEGER NOT NULL DEFAULT 1,
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+            );
+        """)
+
+        _add_column_if_missing(cursor, "attachment_blobs", "key_version", "INTEGER NOT NULL DEFAULT 1")
+
+        # Every key a conversation has had. Version 1 is the original key; a
+        # rotation adds the next version and makes it the current shared_key,
+        # while older versions are kept to read data not yet re-encrypted.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_keys (
+                conversation_id INTEGER NOT NULL,
+                version INTEGER NOT NULL,
+                shared_key BLOB NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (conversation_id, version),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+            );
+        """)
+
+        # Resume points for long-running background jobs.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS job_checkpoints (
+                job TEXT PRIMARY KEY,
+                position INTEGER NOT NULL
+            );
+        """)
+    
         conn.commit()
-        print("Database and all tables (users, messages, conversations) created successfully.")
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-    finally:
-        conn.close()
+
+    backfill_conversation_ids()
+    backfill_last_message_ids()
+    backfill_conversation_summary()
+    backfill_attachment_blobs()
+    backfill_conversation_keys()
+
+def _add_column_if_missing(cursor, table, column, definition):
+    """Adds a column to an existing table unless it is already there."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in [row['name'] for row in cursor.fetchall()]:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+def backfill_conversation_ids(batch_size=BACKFILL_BATCH_SIZE):
+    """Fills in messages.conversation_id for rows written before the column existed.
+
+    Walks the table by id and commits every batch_size rows, so the write lock
+    is only ever held for one short batch at a time.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT MIN(id), MAX(id) FROM messages WHERE conversation_id IS NULL")
+        low, high = cursor.fetchone()
+        if low is None:
+            return
+        while low <= high:
+            cursor.execute("""
+                UPDATE messages SET conversation_id = (
+                    SELECT c.id FROM conversations c
+                    WHERE c.user1_username = MIN(messages.sender_username, messages.receiver_username)
+                      AND c.user2_username = MAX(messages.sender_username, messages.receiver_username)
+                )
+                WHERE id >= ? AND id < ? AND conversation_id IS NULL
+            """, (low, low + batch_size))
+            conn.commit()
+            low += batch_size
+
+def backfill_last_message_ids():
+    """Sets conversations.last_message_id for conversations that have messages but no value yet."""
+    with get_db_connection() as conn:
+        conn.execute("""
+            UPDATE conversations SET last_message_id = (
+                SELECT MAX(id) FROM messages WHERE messages.conversation_id = conversations.id
+            )
+            WHERE last_message_id IS NULL
+        """)
+        conn.commit()
+
+def backfill_conversation_summary():
+    """Adds summary rows for conversations that had messages before the summary table existed."""
+    with get_db_connection() as conn:
+        for user_column, partner_column in (("user1_username", "user2_username"),
+                                            ("user2_username", "user1_username")):
+            conn.execute(f"""
+                INSERT OR IGNORE INTO conversation_summary
+                    (username, conversation_id, partner_username, last_message_id, last_timestamp)
+                SELECT c.{user_column}, c.id, c.{partner_column}, c.last_message_id, m.timestamp
+                FROM conversations c JOIN messages m ON m.id = c.last_message_id
+            """)
+        conn.commit()
+
+def backfill_attachment_blobs():
+    """Registers attachments stored before reference counting existed, with their current counts."""
+    with get_db_connection() as conn:
+        conn.execute("""
+            INSERT OR IGNORE INTO attachment_blobs (path, conversation_id, refcount)
+            SELECT encrypted_file_path, MIN(conversation_id), COUNT(*)
+            FROM messages
+            WHERE encrypted_file_path IS NOT NULL
+            GROUP BY encrypted_file_path
+        """)
+        conn.commit()
+
+def backfill_conversation_keys():
+    """Records the key of conversations created before key versions existed as their version 1."""
+    with get_db_connection() as conn:
+        conn.execute("""
+            INSERT OR IGNORE INTO conversation_keys (conversation_id, version, shared_key)
+            SELECT id, 1, shared_key FROM conversations
+        """)
+        conn.commit()
+
+def create_archive_tables():
+    """Schema version 2: the index of archived message segments (see archive.py)."""
+    with get_db_connection() as conn:
+        # One row per segment file: the id and timestamp range of the messages in it.
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS archive_segments (
+                conversation_id INTEGER NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                first_timestamp DATETIME,
+                last_timestamp DATETIME,
+                message_count INTEGER NOT NULL,
+                path TEXT NOT NULL,
+                key_version INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (conversation_id, first_id),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id)
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_archive_segments_last
+            ON archive_segments (conversation_id, last_id)
+        """)
+        conn.commit()
+
+def create_group_tables():
+    """Schema version 3: group conversations and their members."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        # A group is a conversations row whose user columns both hold its handle ("#name").
+        _add_column_if_missing(cursor, "conversations", "group_name", "TEXT")
+        # Unread counts come from last_read_id, so a message to a group writes no per-member rows.
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS conversation_members (
+                conversation_id INTEGER NOT NULL,
+                username TEXT NOT NULL,
+                last_read_id INTEGER NOT NULL DEFAULT 0,
+                pin TEXT, -- Can be NULL
+                joined_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (conversation_id, username),
+                FOREIGN KEY (conversation_id) REFERENCES conversations (id),
+                FOREIGN KEY (username) REFERENCES users (username)
+            ) WITHOUT ROWID
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_conversation_members_user
+            ON conversation_members (username, conversation_id)
+        """)
+        conn.commit()
+
+# --- Schema versioning ---
+# Each migration brings the schema to its version number. ensure_schema runs
+# the ones a database has not had yet and records the result in schema_version,
+# so adding a change means appending a function here.
+MIGRATIONS = [
+    (1, create_tables),
+    (2, create_archive_tables),
+    (3, create_group_tables),
+]
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+_schema_lock = threading.Lock()
+_schema_ready = False
+
+def get_schema_version():
+    """Returns the schema version recorded in the database, or 0 for one that predates versioning."""
+    with get_db_connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL
+            )
+        """)
+        conn.commit()
+        row = conn.execute("SELECT version FROM schema_version WHERE id = 1").fetchone()
+        return row['version'] if row else 0
+
+def _set_schema_version(version):
+    with get_db_connection() as conn:
+        # MAX keeps a slower process from winding the version back.
+        conn.execute("""
+            INSERT INTO schema_version (id, version) VALUES (1, ?)
+            ON CONFLICT (id) DO UPDATE SET version = MAX(version, excluded.version)
+        """, (version,))
+        conn.commit()
+
+def ensure_schema():
+    """Brings the database up to SCHEMA_VERSION, once per process.
+
+    The first call applies any pending migrations; every later call returns
+    immediately without touching the database. If a migration fails, the
+    error is printed and the next call tries again from that migration.
+    """
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if _schema_ready:
+            return
+        try:
+            current = get_schema_version()
+            for version, migrate in MIGRATIONS:
+                if version > current:
+                    migrate()
+                    _set_schema_version(version)
+                    print(f"Database schema upgraded to version {version}.")
+        except sqlite3.Error as e:
+            print(f"Database error: {e}")
+            return
+        _schema_ready = True
 
 if __name__ == '__main__':
-    create_tables()
\ No newline at end of file
+    ensure_schema()
\ No newline at end of file
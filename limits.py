@@ -0,0 +1,125 @@
+# limits.py
+
+import contextlib
+import math
+import os
+import threading
+import time
+from cache import LRUCache
+import metrics
+
+# Admission control for sends. Every user and every conversation has a token
+# bucket: each message takes one token, tokens come back at a steady rate, and
+# the bucket size allows short bursts. Uploads also need a share of a
+# per-process byte budget while they are being encrypted and written. Requests
+# over a limit are rejected straight away with RateLimitExceeded rather than
+# queued, so one flooding client cannot push everyone else's writes back.
+SEND_RATE_PER_USER = 2.0             # Messages per second a user can keep up
+SEND_BURST_PER_USER = 10             # Messages a user can send at once after being idle
+SEND_RATE_PER_CONVERSATION = 10.0    # Messages per second into one chat, all senders together
+SEND_BURST_PER_CONVERSATION = 30
+MAX_UPLOAD_BYTES = 200 * 1024 * 1024          # Largest single attachment
+UPLOAD_BYTES_IN_FLIGHT = 256 * 1024 * 1024    # Attachment bytes being stored at once, per process
+BUCKET_CACHE_SIZE = 100_000  # Buckets kept; an evicted one starts again full
+
+class RateLimitExceeded(Exception):
+    """A send was rejected by admission control.
+
+    retry_after is the number of seconds after which the same request would
+    be accepted, or None if it never will be (e.g. a file over the size limit).
+    """
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class _TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def wait_time(self, now):
+        """Refills the bucket and returns how long until a token is available (0 if one is)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+_lock = threading.Lock()
+_buckets = LRUCache(max_items=BUCKET_CACHE_SIZE)
+_uploads_in_flight = 0
+_throttled = {'user': 0, 'conversation': 0, 'upload_size': 0, 'upload_budget': 0}
+
+def _bucket(key, rate, burst):
+    bucket = _buckets.get(key)
+    if bucket is None:
+        bucket = _TokenBucket(rate, burst)
+        _buckets.put(key, bucket)
+    return bucket
+
+def _reject(reason, message, retry_after=None):
+    with _lock:
+        _throttled[reason] += 1
+    metrics.increment(f"limits.throttled.{reason}")
+    raise RateLimitExceeded(message, retry_after)
+
+def admit_send(username, conversation_id):
+    """Takes one send token for the user and one for the conversation, or raises RateLimitExceeded.
+
+    A token is only taken when both buckets have one, so a rejected send
+    costs the user nothing.
+    """
+    now = time.monotonic()
+    with _lock:
+        user_bucket = _bucket(('user', username), SEND_RATE_PER_USER, SEND_BURST_PER_USER)
+        chat_bucket = _bucket(('conversation', conversation_id), SEND_RATE_PER_CONVERSATION,
+                              SEND_BURST_PER_CONVERSATION)
+        user_wait = user_bucket.wait_time(now)
+        chat_wait = chat_bucket.wait_time(now)
+        if not user_wait and not chat_wait:
+            user_bucket.tokens -= 1
+            chat_bucket.tokens -= 1
+            return
+    if user_wait:
+        _reject('user', f"You are sending messages too quickly. Try again in {math.ceil(user_wait)} s.", user_wait)
+    _reject('conversation', f"This chat is busy. Try again in {math.ceil(chat_wait)} s.", chat_wait)
+
+def upload_size(source):
+    """Returns the size in bytes of a readable, seekable file object without reading it."""
+    size = getattr(source, 'size', None)
+    if size is not None:
+        return size
+    position = source.tell()
+    size = source.seek(0, os.SEEK_END) - position
+    source.seek(position)
+    return size
+
+@contextlib.contextmanager
+def upload_budget(nbytes):
+    """Reserves nbytes of the process's upload budget for the duration of the block.
+
+    Raises RateLimitExceeded if the file is over MAX_UPLOAD_BYTES or if the
+    budget is taken up by other uploads.
+    """
+    global _uploads_in_flight
+    if nbytes > MAX_UPLOAD_BYTES:
+        _reject('upload_size', f"Files can be at most {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.")
+    with _lock:
+        admitted = _uploads_in_flight + nbytes <= UPLOAD_BYTES_IN_FLIGHT
+        if admitted:
+            _uploads_in_flight += nbytes
+    if not admitted:
+        _reject('upload_budget', "The server is busy with other uploads. Try again in a moment.", 1.0)
+    try:
+        yield
+    finally:
+        with _lock:
+            _uploads_in_flight -= nbytes
+
+def get_throttle_stats():
+    """Returns how many requests each limit has rejected, and the upload bytes in flight."""
+    with _lock:
+        return dict(_throttled, uploads_in_flight_bytes=_uploads_in_flight)
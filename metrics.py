@@ -0,0 +1,166 @@
+# metrics.py
+
+import contextlib
+import functools
+import os
+import threading
+import time
+
+# Instrumentation is opt-in: set CHAT_APP_METRICS=1 before starting the app.
+# When it is off, instrument() hands back the undecorated function and phase()
+# a shared no-op context, so there is nothing left on the hot path.
+ENABLED = os.environ.get("CHAT_APP_METRICS") == "1"
+# Optional file the Prometheus text exposition is rewritten to after every rerun.
+EXPORT_PATH = os.environ.get("CHAT_APP_METRICS_FILE")
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+_lock = threading.Lock()
+_stats = {}  # name -> {'count', 'seconds', 'bytes', 'buckets'}
+_counters = {}  # name -> number of events
+_local = threading.local()
+_NOOP = contextlib.nullcontext()
+
+
+def _record(name, seconds, nbytes):
+    with _lock:
+        stat = _stats.get(name)
+        if stat is None:
+            stat = _stats[name] = {'count': 0, 'seconds': 0.0, 'bytes': 0,
+                                   'buckets': [0] * len(LATENCY_BUCKETS)}
+        stat['count'] += 1
+        stat['seconds'] += seconds
+        stat['bytes'] += nbytes
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                stat['buckets'][i] += 1
+                break
+    rerun = getattr(_local, 'rerun', None)
+    if rerun is not None:
+        entry = rerun.setdefault(name, {'count': 0, 'seconds': 0.0, 'bytes': 0})
+        entry['count'] += 1
+        entry['seconds'] += seconds
+        entry['bytes'] += nbytes
+
+
+def instrument(name, bytes_from=None):
+    """Decorator recording call count, latency and, optionally, bytes processed.
+
+    bytes_from(result, *args, **kwargs) should return the number of bytes the
+    call handled.
+    """
+    def decorator(fn):
+        if not ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = None
+            try:
+                result = fn(*args, **kwargs)
+                return result
+            finally:
+                nbytes = 0
+                if bytes_from is not None:
+                    try:
+                        nbytes = bytes_from(result, *args, **kwargs) or 0
+                    except Exception:
+                        pass
+                _record(name, time.perf_counter() - start, nbytes)
+        return wrapper
+    return decorator
+
+
+def increment(name, amount=1):
+    """Adds amount to the event counter called name, e.g. for rejected requests."""
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+@contextlib.contextmanager
+def _timed_phase(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, time.perf_counter() - start, 0)
+
+def phase(name):
+    """Context manager timing a block, e.g. one render phase of app.main."""
+    return _timed_phase(name) if ENABLED else _NOOP
+
+
+def start_rerun():
+    """Starts collecting a per-rerun breakdown for the calling thread."""
+    _local.rerun = {}
+    _local.rerun_start = time.perf_counter()
+
+def finish_rerun():
+    """Stops collecting and returns {name: {'count', 'seconds', 'bytes'}} for this rerun.
+
+    The total wall time of the rerun is included under 'rerun.total'.
+    """
+    breakdown = getattr(_local, 'rerun', None) or {}
+    _local.rerun = None
+    start = getattr(_local, 'rerun_start', None)
+    if start is not None:
+        total = time.perf_counter() - start
+        _record('rerun.total', total, 0)
+        breakdown['rerun.total'] = {'count': 1, 'seconds': total, 'bytes': 0}
+    if EXPORT_PATH:
+        export_prometheus(EXPORT_PATH)
+    return breakdown
+
+def format_breakdown(breakdown):
+    """Renders a per-rerun breakdown as aligned text, slowest first."""
+    rows = sorted(breakdown.items(), key=lambda item: item[1]['seconds'], reverse=True)
+    return "\n".join(
+        f"{name:<40} {entry['count']:>5}x {entry['seconds'] * 1000:>9.2f} ms"
+        + (f" {entry['bytes']:>10} B" if entry['bytes'] else "")
+        for name, entry in rows
+    )
+
+
+def export_prometheus(path=None):
+    """Returns all metrics in the Prometheus text format, also writing them to path if given."""
+    with _lock:
+        snapshot = {name: dict(stat, buckets=list(stat['buckets'])) for name, stat in _stats.items()}
+        counters = dict(_counters)
+    lines = [
+        "# HELP chatapp_call_duration_seconds Time spent in instrumented calls.",
+        "# TYPE chatapp_call_duration_seconds histogram",
+    ]
+    for name, stat in sorted(snapshot.items()):
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, stat['buckets']):
+            cumulative += count
+            lines.append(f'chatapp_call_duration_seconds_bucket{{name="{name}",le="{bound}"}} {cumulative}')
+        lines.append(f'chatapp_call_duration_seconds_bucket{{name="{name}",le="+Inf"}} {stat["count"]}')
+        lines.append(f'chatapp_call_duration_seconds_sum{{name="{name}"}} {stat["seconds"]}')
+        lines.append(f'chatapp_call_duration_seconds_count{{name="{name}"}} {stat["count"]}')
+    lines.append("# HELP chatapp_bytes_processed_total Bytes handled by instrumented calls.")
+    lines.append("# TYPE chatapp_bytes_processed_total counter")
+    for name, stat in sorted(snapshot.items()):
+        if stat['bytes']:
+            lines.append(f'chatapp_bytes_processed_total{{name="{name}"}} {stat["bytes"]}')
+    if counters:
+        lines.append("# HELP chatapp_events_total Events counted by the app, such as throttled requests.")
+        lines.append("# TYPE chatapp_events_total counter")
+        for name, count in sorted(counters.items()):
+            lines.append(f'chatapp_events_total{{name="{name}"}} {count}')
+    text = "\n".join(lines) + "\n"
+    if path:
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    return text
+
+def reset():
+    """Clears every recorded metric."""
+    with _lock:
+        _stats.clear()
+        _counters.clear()
@@ -0,0 +1,148 @@
+# notify.py
+
+import argparse
+import asyncio
+import socket
+import threading
+
+# Where to reach the notification hub. None runs it inside this process on a
+# background event loop; set ("127.0.0.1", 8765) to share one sidecar started
+# with `python notify.py` between several app processes.
+NOTIFY_ADDRESS = None
+
+# An open chat checks the hub from a fragment that reruns the app only when a
+# new message has arrived. The check does not block, so clicks are never held
+# up; it runs every LISTEN_MIN_INTERVAL_SECONDS while the chat is active and
+# the interval doubles for every IDLE_STEP_SECONDS of silence. The full-page
+# refresh only keeps the sidebar (contacts, unread counts) up to date, so
+# several app processes need the sidecar to see each other's messages quickly.
+LISTEN_MIN_INTERVAL_SECONDS = 1.0
+LISTEN_MAX_INTERVAL_SECONDS = 16.0
+IDLE_STEP_SECONDS = 30
+SIDEBAR_REFRESH_MS = 30000
+
+
+class NotificationHub:
+    """Remembers the newest message id per conversation and wakes up anyone waiting on it.
+
+    All methods must be called on the hub's event loop.
+    """
+
+    def __init__(self):
+        self._latest = {}
+        self._waiters = {}  # conversation_id -> set of futures
+
+    def publish(self, conversation_id, message_id):
+        if message_id <= self._latest.get(conversation_id, 0):
+            return
+        self._latest[conversation_id] = message_id
+        for waiter in self._waiters.pop(conversation_id, set()):
+            if not waiter.done():
+                waiter.set_result(message_id)
+
+    def latest(self, conversation_id):
+        return self._latest.get(conversation_id, 0)
+
+    async def wait(self, conversation_id, since_id, timeout):
+        """Returns the newest message id once it is above since_id, or None after timeout seconds."""
+        if self.latest(conversation_id) > since_id:
+            return self.latest(conversation_id)
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(conversation_id, set()).add(waiter)
+        try:
+            return await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            self._waiters.get(conversation_id, set()).discard(waiter)
+
+
+# --- In-process hub ---
+_hub = None
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _hub, _loop
+    with _loop_lock:
+        if _loop is None:
+            _loop = asyncio.new_event_loop()
+            _hub = NotificationHub()
+            threading.Thread(target=_loop.run_forever, name="chat-notify", daemon=True).start()
+    return _loop
+
+
+# --- Sidecar client ---
+def _sidecar_request(line, timeout):
+    with socket.create_connection(NOTIFY_ADDRESS, timeout=timeout) as sock:
+        sock.sendall(f"{line}\n".encode())
+        return sock.makefile().readline().strip()
+
+
+def publish(conversation_id, message_id):
+    """Announces that message_id was committed to a conversation. Never raises."""
+    try:
+        if NOTIFY_ADDRESS:
+            _sidecar_request(f"PUB {conversation_id} {message_id}", timeout=1)
+        else:
+            loop = _get_loop()
+            loop.call_soon_threadsafe(_hub.publish, conversation_id, message_id)
+    except OSError as e:
+        print(f"Notification failed: {e}")
+
+def wait_for_message(conversation_id, since_id, timeout=25):
+    """Blocks until the conversation has a message newer than since_id.
+
+    Returns the newest message id, or None if nothing arrived within timeout
+    seconds; timeout=0 only checks what has already been published.
+    """
+    try:
+        if NOTIFY_ADDRESS:
+            reply = _sidecar_request(f"WAIT {conversation_id} {since_id} {timeout}", timeout=timeout + 1)
+            return int(reply.split()[1]) if reply.startswith("MSG") else None
+        future = asyncio.run_coroutine_threadsafe(_hub_wait(conversation_id, since_id, timeout), _get_loop())
+        return future.result(timeout + 1)
+    except (OSError, TimeoutError) as e:
+        print(f"Notification wait failed: {e}")
+        return None
+
+async def _hub_wait(conversation_id, since_id, timeout):
+    return await _hub.wait(conversation_id, since_id, timeout)
+
+def listen_interval_seconds(idle_seconds):
+    """Returns how often an open chat should check for new messages after idle_seconds of silence."""
+    steps = int(idle_seconds // IDLE_STEP_SECONDS)
+    return min(LISTEN_MAX_INTERVAL_SECONDS, LISTEN_MIN_INTERVAL_SECONDS * 2 ** min(steps, 16))
+
+
+# --- Sidecar server ---
+async def _handle_client(reader, writer, hub):
+    try:
+        parts = (await reader.readline()).decode().split()
+        if len(parts) == 3 and parts[0] == "PUB":
+            hub.publish(int(parts[1]), int(parts[2]))
+            reply = "OK"
+        elif len(parts) == 4 and parts[0] == "WAIT":
+            latest = await hub.wait(int(parts[1]), int(parts[2]), float(parts[3]))
+            reply = f"MSG {latest}" if latest is not None else "TIMEOUT"
+        else:
+            reply = "ERR"
+        writer.write(f"{reply}\n".encode())
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def serve(host, port):
+    """Runs the notification hub as a standalone TCP service."""
+    hub = NotificationHub()
+    server = await asyncio.start_server(lambda r, w: _handle_client(r, w, hub), host, port)
+    print(f"Notification service listening on {host}:{port}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run the chat notification sidecar.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
@@ -0,0 +1,228 @@
+# rekey.py
+
+import argparse
+import os
+import threading
+import time
+import uuid
+from cryptography.fernet import InvalidToken
+from archive import rewrite_segments
+from attachments import forget_attachment
+from chat import get_or_create_conversation, invalidate_conversation
+from crypto import decrypt_stream, encrypt_stream, generate_key, get_fernet
+from database import ensure_schema, get_db_connection
+from metrics import instrument
+import writer
+
+# Key rotation happens in two steps. rotate_conversation_key adds a new key
+# version and makes it current in one short transaction: from then on new
+# messages use it, while everything older stays readable because readers try
+# every version of the key. reencrypt_conversation then rewrites the old data
+# in the background, a batch at a time, so the chat never stops working.
+# Old key versions are kept in conversation_keys; nothing retires them yet.
+#
+# Rotation protects message and attachment content only. Search tokens and
+# attachment content addresses stay derived from the conversation's first key,
+# so a holder of that key can still test guessed words against the search
+# index and tell whether a known file was sent, for messages sent after the
+# rotation too.
+REKEY_BATCH_SIZE = 200  # Messages re-encrypted per transaction
+REKEY_JOB_PREFIX = "rekey:"
+
+def _job_name(conversation_id):
+    return f"{REKEY_JOB_PREFIX}{conversation_id}"
+
+def _load_keys(conversation_id):
+    """Returns (current version, every key newest first) straight from the database."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT version, shared_key FROM conversation_keys WHERE conversation_id = ? ORDER BY version DESC",
+            (conversation_id,)
+        )
+        rows = cursor.fetchall()
+    return rows[0]['version'], tuple(row['shared_key'] for row in rows)
+
+@instrument("rekey.rotate_conversation_key")
+def rotate_conversation_key(user1, user2, background=True, batch_size=REKEY_BATCH_SIZE, pause_seconds=0.0):
+    """Gives a conversation a new key and starts re-encrypting its history with it.
+
+    Returns the new key version. With background=False the re-encryption runs
+    in the calling thread and has finished when this returns.
+    """
+    conversation_id = get_or_create_conversation(user1, user2)['id']
+    new_key = generate_key()
+
+    def job(cursor):
+        cursor.execute("SELECT key_version FROM conversations WHERE id = ?", (conversation_id,))
+        version = cursor.fetchone()['key_version'] + 1
+        cursor.execute(
+            "INSERT INTO conversation_keys (conversation_id, version, shared_key) VALUES (?, ?, ?)",
+            (conversation_id, version, new_key)
+        )
+        # version is bumped too so open chats notice and reload their keys.
+        cursor.execute(
+            "UPDATE conversations SET shared_key = ?, key_version = ?, version = version + 1 WHERE id = ?",
+            (new_key, version, conversation_id)
+        )
+        cursor.execute("DELETE FROM job_checkpoints WHERE job = ?", (_job_name(conversation_id),))
+        return version
+
+    version = writer.run(job)
+    invalidate_conversation(user1, user2)
+    if background:
+        threading.Thread(
+            target=reencrypt_conversation, args=(conversation_id, batch_size, pause_seconds),
+            name=f"rekey-{conversation_id}", daemon=True
+        ).start()
+    else:
+        reencrypt_conversation(conversation_id, batch_size, pause_seconds)
+    return version
+
+def _reencrypt_blob(path, keys):
+    """Rewrites one attachment blob in place under keys[0], via a temporary file and an atomic rename."""
+    temp_path = os.path.join(os.path.dirname(path), f".rekey-{uuid.uuid4().hex}")
+    try:
+        with open(path, "rb") as source, open(temp_path, "wb") as dest:
+            for block in encrypt_stream(_ChunkReader(decrypt_stream(source, keys)), keys[0]):
+                dest.write(block)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    forget_attachment(path)
+
+class _ChunkReader:
+    """Adapts an iterator of byte chunks to the read(size) interface encrypt_stream expects."""
+
+    def __init__(self, chunks):
+        self._chunks = chunks
+        self._buffer = b""
+
+    def read(self, size):
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        return data
+
+@instrument("rekey.reencrypt_conversation")
+def reencrypt_conversation(conversation_id, batch_size=REKEY_BATCH_SIZE, pause_seconds=0.0):
+    """Re-encrypts a conversation's attachments and messages with its current key.
+
+    Attachments go first, one blob per transaction; text messages follow in
+    batches, checkpointed in job_checkpoints so an interrupted run resumes
+    where it stopped, and archived segments last. Data that fails to decrypt
+    is left as it is. Returns (blobs re-encrypted, messages re-encrypted).
+    """
+    version, keys = _load_keys(conversation_id)
+    job_name = _job_name(conversation_id)
+
+    blobs = 0
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT path FROM attachment_blobs WHERE conversation_id = ? AND key_version < ? AND refcount > 0",
+            (conversation_id, version)
+        )
+        paths = [row['path'] for row in cursor.fetchall()]
+    for path in paths:
+        try:
+            _reencrypt_blob(path, keys)
+        except (InvalidToken, FileNotFoundError) as e:
+            print(f"Skipping attachment {path}: {e!r}")
+            continue
+
+        def job(cursor, path=path):
+            cursor.execute("UPDATE attachment_blobs SET key_version = ? WHERE path = ?", (version, path))
+            cursor.execute(
+                "UPDATE messages SET key_version = ? WHERE encrypted_file_path = ? AND key_version < ?",
+                (version, path, version)
+            )
+        writer.run(job)
+        blobs += 1
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT position FROM job_checkpoints WHERE job = ?", (job_name,))
+        row = cursor.fetchone()
+        position = row['position'] if row else 0
+
+    fernet = get_fernet(keys)
+    messages = 0
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT id, encrypted_message FROM messages
+                WHERE conversation_id = ? AND id > ? AND key_version < ? AND message_type = 'text'
+                ORDER BY id
+                LIMIT ?
+                """,
+                (conversation_id, position, version, batch_size)
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        batch = []
+        for row in rows:
+            try:
+                batch.append((fernet.rotate(row['encrypted_message']), version, row['id']))
+            except InvalidToken:
+                print(f"Skipping message {row['id']}: it does not decrypt with any key of the conversation")
+        position = rows[-1]['id']
+
+        def job(cursor, batch=batch, position=position):
+            cursor.executemany("UPDATE messages SET encrypted_message = ?, key_version = ? WHERE id = ?", batch)
+            cursor.execute(
+                "INSERT OR REPLACE INTO job_checkpoints (job, position) VALUES (?, ?)",
+                (job_name, position)
+            )
+        writer.run(job)
+        messages += len(batch)
+        if pause_seconds:
+            time.sleep(pause_seconds)
+
+    rewrite_segments(conversation_id, version, keys)
+    return blobs, messages
+
+def resume_pending(batch_size=REKEY_BATCH_SIZE, pause_seconds=0.0):
+    """Finishes every re-encryption left behind by an interrupted process."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT c.id FROM conversations c
+            WHERE EXISTS (SELECT 1 FROM messages m
+                          WHERE m.conversation_id = c.id AND m.key_version < c.key_version)
+               OR EXISTS (SELECT 1 FROM attachment_blobs b
+                          WHERE b.conversation_id = c.id AND b.key_version < c.key_version AND b.refcount > 0)
+               OR EXISTS (SELECT 1 FROM archive_segments s
+                          WHERE s.conversation_id = c.id AND s.key_version < c.key_version)
+        """)
+        conversation_ids = [row['id'] for row in cursor.fetchall()]
+    return {cid: reencrypt_conversation(cid, batch_size, pause_seconds) for cid in conversation_ids}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rotate conversation keys and re-encrypt stored data.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    rotate_parser = subparsers.add_parser("rotate", help="give a conversation a new key")
+    rotate_parser.add_argument("user1")
+    rotate_parser.add_argument("user2")
+    resume_parser = subparsers.add_parser("resume", help="finish interrupted re-encryptions")
+    for sub in (rotate_parser, resume_parser):
+        sub.add_argument("--batch-size", type=int, default=REKEY_BATCH_SIZE)
+        sub.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    ensure_schema()
+    if args.command == "rotate":
+        version = rotate_conversation_key(args.user1, args.user2, False, args.batch_size, args.pause)
+        print(f"Conversation key rotated to version {version}.")
+    else:
+        for conversation_id, (blobs, messages) in resume_pending(args.batch_size, args.pause).items():
+            print(f"Conversation {conversation_id}: {blobs} attachments and {messages} messages re-encrypted.")
@@ -0,0 +1,41 @@
+# render.py
+
+import html
+
+def _bubble_html(msg, username, body_html):
+    """Wraps already-escaped body HTML in a chat bubble for msg."""
+    is_user_message = (msg['sender_username'] == username)
+    row_class = "user-message-row" if is_user_message else "other-message-row"
+    message_class = "chat-message user-message" if is_user_message else "chat-message other-message"
+    return (
+        f'<div class="message-row {row_class}"><div class="{message_class}">'
+        f'<span class="sender">{html.escape(msg["sender_username"])}</span>'
+        f'{body_html}'
+        f'<span class="timestamp">{html.escape(msg["timestamp"].split(".")[0])}</span>'
+        '</div></div>'
+    )
+
+def message_html(msg, username):
+    """Returns the HTML bubble for one message; attachments only get their filename."""
+    if msg['message_type'] == 'text':
+        body = f'<div class="message-content">{html.escape(msg["message"])}</div>'
+    else:
+        icon = "🖼️" if msg['message_type'] == 'image' else "📎"
+        body = f'<div class="file-content">{icon} {html.escape(msg["filename"])}</div>'
+    return _bubble_html(msg, username, body)
+
+def render_message_groups(messages, username):
+    """Splits messages into runs that can each be sent to the browser as one HTML block.
+
+    Yields ('html', block) for every run of bubbles, and ('attachment', msg)
+    right after the bubble of each attachment, where its widget goes.
+    """
+    parts = []
+    for msg in messages:
+        parts.append(message_html(msg, username))
+        if msg['message_type'] != 'text':
+            yield 'html', "".join(parts)
+            parts = []
+            yield 'attachment', msg
+    if parts:
+        yield 'html', "".join(parts)
@@ -0,0 +1,134 @@
+# search.py
+
+import argparse
+import base64
+import hashlib
+import hmac
+import re
+import time
+from functools import lru_cache
+from crypto import decrypt_message, DECRYPTION_FAILED_TEXT
+from database import get_db_connection
+import writer
+
+# Messages are searchable through a blind index: for every word of a message we
+# store HMAC(index key, word), where the index key is derived from the
+# conversation's first shared key (so it survives key rotation). The server can match query tokens against stored
+# tokens without ever seeing the words, and only matching messages get decrypted.
+# Because the index key never changes, anyone holding the first key can test
+# guessed words against every message's tokens, including ones sent after a rotation.
+TOKEN_BYTES = 16           # Truncated HMAC length stored per word
+MAX_WORD_LENGTH = 64       # Longer "words" are cut down before hashing
+BACKFILL_BATCH_SIZE = 500  # Messages indexed per transaction by the backfill job
+BACKFILL_JOB = "search_index_backfill"
+
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+def tokenize(text):
+    """Splits text into the set of normalized words that get indexed."""
+    return {word[:MAX_WORD_LENGTH] for word in _WORD_RE.findall(text.casefold())}
+
+@lru_cache(maxsize=1024)
+def _index_key(shared_key):
+    """Derives the blind-index key from a conversation's shared key."""
+    return hmac.new(base64.urlsafe_b64decode(shared_key), b"chatapp blind index", hashlib.sha256).digest()
+
+def blind_tokens(text, shared_key):
+    """Returns the blind-index tokens for every word in text."""
+    index_key = _index_key(shared_key)
+    return {
+        hmac.new(index_key, word.encode(), hashlib.sha256).digest()[:TOKEN_BYTES]
+        for word in tokenize(text)
+    }
+
+def store_tokens(cursor, conversation_id, message_id, tokens):
+    """Write-queue job step: records a message's tokens in the index."""
+    cursor.executemany(
+        "INSERT OR IGNORE INTO message_search_tokens (conversation_id, token, message_id) VALUES (?, ?, ?)",
+        [(conversation_id, token, message_id) for token in tokens]
+    )
+
+def find_message_ids(conversation_id, query, shared_key, limit=50):
+    """Returns ids of the newest messages containing every word of query, newest first."""
+    tokens = list(blind_tokens(query, shared_key))
+    if not tokens:
+        return []
+    lookup = "SELECT message_id FROM message_search_tokens WHERE conversation_id = ? AND token = ?"
+    sql = " INTERSECT ".join([lookup] * len(tokens)) + " ORDER BY message_id DESC LIMIT ?"
+    params = [value for token in tokens for value in (conversation_id, token)]
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, (*params, limit))
+        return [row['message_id'] for row in cursor.fetchall()]
+
+
+# --- Backfill for messages written before the index existed ---
+def _message_text(row):
+    """Returns the searchable text of a message row (its text, or the attachment's filename)."""
+    if row['message_type'] == 'text':
+        text = decrypt_message(row['encrypted_message'], row['shared_key'])
+        return None if text == DECRYPTION_FAILED_TEXT else text
+    return row['original_filename']
+
+def backfill_search_index(batch_size=BACKFILL_BATCH_SIZE, pause_seconds=0.0):
+    """Indexes every message that was stored before the blind index existed.
+
+    Progress is checkpointed in job_checkpoints after every batch, so the job
+    can be stopped and resumed. pause_seconds between batches leaves the write
+    lock free for live traffic. Returns the number of messages indexed.
+    """
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT position FROM job_checkpoints WHERE job = ?", (BACKFILL_JOB,))
+        row = cursor.fetchone()
+        position = row['position'] if row else 0
+        # Newer messages are indexed as they are written, so stop at today's newest.
+        cursor.execute("SELECT COALESCE(MAX(id), 0) FROM messages")
+        upper = cursor.fetchone()[0]
+
+    indexed = 0
+    while position < upper:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT m.id, m.conversation_id, m.message_type, m.encrypted_message,
+                       m.original_filename, k.shared_key, base.shared_key AS base_key
+                FROM messages m
+                JOIN conversation_keys k ON k.conversation_id = m.conversation_id AND k.version = m.key_version
+                JOIN conversation_keys base ON base.conversation_id = m.conversation_id AND base.version = 1
+                WHERE m.id > ? AND m.id <= ?
+                ORDER BY m.id
+                LIMIT ?
+                """,
+                (position, upper, batch_size)
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            break
+        batch = []
+        for row in rows:
+            text = _message_text(row)
+            if text:
+                batch.append((row['conversation_id'], row['id'], blind_tokens(text, row['base_key'])))
+        position = rows[-1]['id']
+
+        def job(cursor, batch=batch, position=position):
+            for conversation_id, message_id, tokens in batch:
+                store_tokens(cursor, conversation_id, message_id, tokens)
+            cursor.execute(
+                "INSERT OR REPLACE INTO job_checkpoints (job, position) VALUES (?, ?)",
+                (BACKFILL_JOB, position)
+            )
+        writer.run(job)
+        indexed += len(batch)
+        if pause_seconds:
+            time.sleep(pause_seconds)
+    return indexed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the blind search index for existing messages.")
+    parser.add_argument("--batch-size", type=int, default=BACKFILL_BATCH_SIZE)
+    parser.add_argument("--pause", type=float, default=0.0, help="seconds to sleep between batches")
+    args = parser.parse_args()
+    print(f"Indexed {backfill_search_index(args.batch_size, args.pause)} messages.")
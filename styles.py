@@ -1,16 +1,17 @@
 # styles.py
 
+import hashlib
+import re
 from themes import THEMES
 
-def load_css(theme_name="Default"):
+# Set "Rose Petal" as the new default theme
+DEFAULT_THEME = "Rose Petal"
+
+def _build_css(theme):
     """
     Returns a robust CSS that uses a full theme definition for a layered look.
     """
-    # Set "Rose Petal" as the new default theme
-    theme = THEMES.get(theme_name, THEMES["Rose Petal"]) 
-    
     css = f"""
-        <style>
             /* --- Main App and Sidebar --- */
             .stApp {{
                 background-color: {theme['page_bg']};
@@ -98,6 +99,28 @@ def load_css(theme_name="Default"):
                 color: rgba(0, 0, 0, 0.5); /* Semi-transparent black for timestamps */
                 align-self: flex-end; 
             }}
-        </style>
     """
-    return css
\ No newline at end of file
+    return css
+
+def _minify(css):
+    """Strips comments and whitespace that the browser does not need."""
+    css = re.sub(r"/\*.*?\*/", "", css, flags=re.S)
+    css = re.sub(r"\s+", " ", css)
+    css = re.sub(r"\s*([{}:;,])\s*", r"\1", css)
+    return css.replace(";}", "}").strip()
+
+# Every theme's CSS is built once at import time instead of on every rerun.
+_CSS_HASHES = {}
+_CSS = {}
+for _name, _theme in THEMES.items():
+    _minified = _minify(_build_css(_theme))
+    _CSS_HASHES[_name] = hashlib.sha256(_minified.encode()).hexdigest()[:16]
+    _CSS[_name] = f'<style data-css-hash="{_CSS_HASHES[_name]}">{_minified}</style>'
+
+def load_css(theme_name="Default"):
+    """Returns the precomputed, minified <style> block for a theme."""
+    return _CSS.get(theme_name, _CSS[DEFAULT_THEME])
+
+def get_css_hash(theme_name="Default"):
+    """Returns a short content hash of the theme's CSS, to tell whether it needs re-injecting."""
+    return _CSS_HASHES.get(theme_name, _CSS_HASHES[DEFAULT_THEME])
\ No newline at end of file
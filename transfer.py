@@ -0,0 +1,448 @@
+# transfer.py
+
+import itertools
+import json
+import os
+from archive import iter_archived_segments
+from attachments import add_attachment_reference, store_attachment
+from chat import create_group, get_or_create_conversation
+from contacts import GROUP_PREFIX, invalidate_directory
+from crypto import DECRYPTION_FAILED_TEXT, decrypt_messages, encrypt_message, iter_decrypt_file
+from database import ensure_schema, get_db_connection
+from metrics import instrument
+from search import blind_tokens, store_tokens
+import writer
+
+# An export is a directory with messages.jsonl and an attachments/ folder.
+# messages.jsonl holds one record per line, each conversation record followed
+# by that conversation's messages, oldest first:
+#   {"type": "user", "username": ..., "password": <hash>}
+#   {"type": "conversation", "id": ..., "users": [u1, u2]}
+#   {"type": "conversation", "id": ..., "group": name, "members": [...]}
+#   {"type": "message", "conversation": ..., "id": ..., "sender": ..., "receiver": ...,
+#    "timestamp": ..., "message_type": ..., "text": ...}   (attachments: "attachment"
+#    and "filename" instead of "text")
+# Messages and attachments are written decrypted and accounts with their
+# password hashes, so an export needs the same protection as the database and
+# its keys together. Both directions work batch by batch and keep only one
+# batch in memory, whatever the size of the history.
+EXPORT_BATCH_SIZE = 500   # Messages decrypted and written per checkpoint
+IMPORT_BATCH_SIZE = 500   # Messages encrypted and inserted per transaction
+MESSAGES_FILE = "messages.jsonl"
+ATTACHMENTS_DIR = "attachments"
+CHECKPOINT_FILE = "checkpoint.json"
+IMPORT_JOB_PREFIX = "import:"
+
+def _conversation_keys(conversation_id):
+    """Returns every key version of a conversation, newest first."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT shared_key FROM conversation_keys WHERE conversation_id = ? ORDER BY version DESC",
+            (conversation_id,)
+        )
+        return tuple(row['shared_key'] for row in cursor.fetchall())
+
+
+# --- Export ---
+class _ExportWriter:
+    """Appends records to messages.jsonl and remembers how far the export has got.
+
+    The checkpoint holds the size of messages.jsonl at the last completed
+    batch; anything written after it is cut off when an export resumes.
+    """
+
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        os.makedirs(os.path.join(dest_dir, ATTACHMENTS_DIR), exist_ok=True)
+        self.checkpoint_path = os.path.join(dest_dir, CHECKPOINT_FILE)
+        self.checkpoint = {'offset': 0, 'conversation_id': 0, 'message_id': 0}
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as f:
+                self.checkpoint = json.load(f)
+        self.file = open(os.path.join(dest_dir, MESSAGES_FILE), "ab")
+        self.file.truncate(self.checkpoint['offset'])
+        self.users = set()
+
+    def write(self, records):
+        self.file.write(b"".join(json.dumps(record).encode() + b"\n" for record in records))
+
+    def save(self, conversation_id, message_id):
+        """Makes everything written so far durable and records it as the resume point."""
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.checkpoint = {'offset': self.file.tell(), 'conversation_id': conversation_id, 'message_id': message_id}
+        temp_path = f"{self.checkpoint_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.checkpoint, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def attachment(self, path, keys):
+        """Writes the decrypted contents of a blob into attachments/ once; returns its export name."""
+        name = os.path.join(ATTACHMENTS_DIR, os.path.splitext(os.path.basename(path))[0])
+        dest = os.path.join(self.dest_dir, name)
+        if os.path.exists(dest):
+            return name
+        from cryptography.fernet import InvalidToken
+        temp_path = f"{dest}.tmp"
+        try:
+            with open(temp_path, "wb") as f:
+                for chunk in iter_decrypt_file(path, keys):
+                    f.write(chunk)
+            os.replace(temp_path, dest)
+        except (InvalidToken, FileNotFoundError) as e:
+            print(f"Skipping attachment {path}: {e!r}")
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            return None
+        return name
+
+    def close(self):
+        self.file.close()
+
+def _iter_conversations(start_id, conversation_ids=None, page_size=EXPORT_BATCH_SIZE):
+    """Yields conversation rows with an id of at least start_id, in id order, a page at a time."""
+    last_id = start_id - 1
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT id, user1_username, user2_username, group_name FROM conversations "
+                "WHERE id > ? ORDER BY id LIMIT ?",
+                (last_id, page_size)
+            )
+            rows = cursor.fetchall()
+        if not rows:
+            return
+        for row in rows:
+            if conversation_ids is None or row['id'] in conversation_ids:
+                yield row
+        last_id = rows[-1]['id']
+
+def _iter_message_batches(conversation_id, keys, since_id, batch_size):
+    """Yields a conversation's message rows above since_id in batches, archived ones first."""
+    for rows in iter_archived_segments(conversation_id, keys, since_id):
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            since_id = batch[-1]['id']
+            yield batch
+    while True:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT * FROM messages WHERE conversation_id = ? AND id > ? ORDER BY id LIMIT ?",
+                (conversation_id, since_id, batch_size)
+            )
+            batch = cursor.fetchall()
+        if not batch:
+            return
+        since_id = batch[-1]['id']
+        yield batch
+
+def _header_records(conversation, out):
+    """Returns the conversation record, preceded by records for participants not exported yet."""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        if conversation['group_name'] is not None:
+            cursor.execute(
+                "SELECT username FROM conversation_members WHERE conversation_id = ? ORDER BY username",
+                (conversation['id'],)
+            )
+            members = [row['username'] for row in cursor.fetchall()]
+            header = {'type': 'conversation', 'id': conversation['id'],
+                      'group': conversation['group_name'], 'members': members}
+        else:
+            members = [conversation['user1_username'], conversation['user2_username']]
+            header = {'type': 'conversation', 'id': conversation['id'], 'users': members}
+        new_users = [name for name in members if name not in out.users]
+        placeholders = ", ".join("?" * len(new_users))
+        cursor.execute(f"SELECT username, password FROM users WHERE username IN ({placeholders})", new_users)
+        records = [{'type': 'user', 'username': row['username'], 'password': row['password']}
+                   for row in cursor.fetchall()]
+    out.users.update(new_users)
+    return records + [header]
+
+def _message_records(rows, keys, out):
+    """Decrypts one batch of message rows into export records."""
+    text_rows = [row for row in rows if row['message_type'] == 'text']
+    texts = dict(zip(
+        [row['id'] for row in text_rows],
+        decrypt_messages([row['encrypted_message'] for row in text_rows], keys)
+    ))
+    records = []
+    for row in rows:
+        record = {
+            'type': 'message', 'conversation': row['conversation_id'], 'id': row['id'],
+            'sender': row['sender_username'], 'receiver': row['receiver_username'],
+            'timestamp': row['timestamp'], 'message_type': row['message_type'],
+        }
+        if row['message_type'] == 'text':
+            text = texts[row['id']]
+            record['text'] = None if text == DECRYPTION_FAILED_TEXT else text
+        else:
+            record['attachment'] = out.attachment(row['encrypted_file_path'], keys)
+            record['filename'] = row['original_filename']
+        records.append(record)
+    return records
+
+@instrument("transfer.export_conversations")
+def export_conversations(dest_dir, conversation_ids=None, batch_size=EXPORT_BATCH_SIZE):
+    """Streams conversations (all of them, or those in conversation_ids) into dest_dir.
+
+    Progress is checkpointed after every batch; calling this again with the
+    same dest_dir resumes after the last completed batch. Returns the number
+    of messages exported by this call.
+    """
+    out = _ExportWriter(dest_dir)
+    resume_id, resume_since = out.checkpoint['conversation_id'], out.checkpoint['message_id']
+    exported = 0
+    try:
+        for conversation in _iter_conversations(resume_id, conversation_ids):
+            conversation_id = conversation['id']
+            keys = _conversation_keys(conversation_id)
+            if conversation_id == resume_id:
+                since_id = resume_since  # Its conversation record is already in the file
+            else:
+                out.write(_header_records(conversation, out))
+                out.save(conversation_id, 0)
+                since_id = 0
+            for batch in _iter_message_batches(conversation_id, keys, since_id, batch_size):
+                out.write(_message_records(batch, keys, out))
+                out.save(conversation_id, batch[-1]['id'])
+                exported += len(batch)
+    finally:
+        out.close()
+    return exported
+
+
+# --- Import ---
+def _import_user(record):
+    with get_db_connection() as conn:
+        conn.execute(
+            "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+            (record['username'], record['password'])
+        )
+        conn.commit()
+    invalidate_directory()
+
+def _import_group(record, job):
+    """Returns the handle of the group this import created for a group record, creating it the first time.
+
+    Which group was created for which exported one is kept in job_checkpoints,
+    so a resumed import finds its own group again. A group that already has
+    the exported name belongs to someone else and is never joined; the import
+    creates "name-2", "name-3", ... instead. Returns None if no group can be
+    created under the name.
+    """
+    mapping = f"{job}:group:{record['id']}"
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            """
+            SELECT c.user1_username FROM job_checkpoints j JOIN conversations c ON c.id = j.position
+            WHERE j.job = ? AND c.group_name IS NOT NULL
+            """,
+            (mapping,)
+        )
+        row = cursor.fetchone()
+    if row:
+        return row['user1_username']
+    members = record['members']
+    for attempt in itertools.count(1):
+        name = record['group'] if attempt == 1 else f"{record['group']}-{attempt}"
+        handle = create_group(name, members[0], members)
+        if handle:
+            break
+        with get_db_connection() as conn:
+            taken = conn.execute(
+                "SELECT 1 FROM conversations WHERE user1_username = ?", (GROUP_PREFIX + name,)
+            ).fetchone()
+        if not taken:
+            return None
+    conversation_id = get_or_create_conversation(members[0], handle)['id']
+    with get_db_connection() as conn:
+        conn.execute("INSERT OR REPLACE INTO job_checkpoints (job, position) VALUES (?, ?)", (mapping, conversation_id))
+        conn.commit()
+    return handle
+
+def _import_conversation(record, job):
+    """Finds or creates the conversation a conversation record describes; returns the import target.
+
+    New conversations get new keys, so nothing from the source database's
+    keys carries over.
+    """
+    if 'group' not in record:
+        user1, user2 = record['users']
+        return {'conversation': get_or_create_conversation(user1, user2), 'group': False, 'users': (user1, user2)}
+    members = record['members']
+    if not members:
+        print(f"Skipping group {record['group']}: it has no members")
+        return None
+    handle = _import_group(record, job)
+    if handle is None:
+        print(f"Skipping group {record['group']}: no group can be created under that name")
+        return None
+    return {
+        'conversation': get_or_create_conversation(members[0], handle), 'group': True, 'users': (),
+        'handle': handle,
+    }
+
+def _prepare_message(record, target, src_dir):
+    """Encrypts one message record under the target conversation's current key, or returns None."""
+    conversation = target['conversation']
+    key = conversation['shared_key']
+    prepared = {
+        # The group may have been imported under another name than the exported one.
+        'sender': record['sender'], 'receiver': target['handle'] if target['group'] else record['receiver'],
+        'timestamp': record['timestamp'],
+        'message_type': record['message_type'], 'encrypted_message': None,
+        'file_path': None, 'filename': None, 'size': None,
+    }
+    if record['message_type'] == 'text':
+        if record['text'] is None:
+            return None
+        prepared['encrypted_message'] = encrypt_message(record['text'], key)
+        prepared['tokens'] = blind_tokens(record['text'], conversation['base_key'])
+        return prepared
+    if record['attachment'] is None:
+        return None
+    with open(os.path.join(src_dir, record['attachment']), "rb") as f:
+        prepared['file_path'], prepared['size'] = store_attachment(f, key, address_key=conversation['base_key'])
+    prepared['filename'] = record['filename']
+    prepared['tokens'] = blind_tokens(record['filename'], conversation['base_key'])
+    return prepared
+
+def _insert_batch(cursor, target, batch, job, position, header_position):
+    """Write-queue job: inserts a batch of prepared messages and moves the import checkpoint."""
+    conversation = target['conversation']
+    cursor.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'messages'), 0),
+                   COALESCE((SELECT MAX(id) FROM messages), 0))
+    """)
+    # Ids are assigned here, inside the write transaction, so the search index can refer to them.
+    # They are above every existing id while the timestamps are the source's, so imported history
+    # breaks the usual id/time order; archive_conversation allows for that.
+    first_id = cursor.fetchone()[0] + 1
+    message_ids = range(first_id, first_id + len(batch))
+    cursor.executemany(
+        """
+        INSERT INTO messages (id, conversation_id, sender_username, receiver_username, timestamp, message_type,
+                              encrypted_message, encrypted_file_path, original_filename, key_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+        [(message_id, conversation['id'], m['sender'], m['receiver'], m['timestamp'], m['message_type'],
+          m['encrypted_message'], m['file_path'], m['filename'], conversation['key_version'])
+         for message_id, m in zip(message_ids, batch)]
+    )
+    for message_id, m in zip(message_ids, batch):
+        if m['file_path']:
+            add_attachment_reference(cursor, m['file_path'], conversation['id'], m['size'], conversation['key_version'])
+        store_tokens(cursor, conversation['id'], message_id, m['tokens'])
+
+    last_id = message_ids[-1]
+    cursor.execute(
+        "UPDATE conversations SET version = version + 1, last_message_id = ? WHERE id = ?",
+        (last_id, conversation['id'])
+    )
+    # Imported history counts as read.
+    if target['group']:
+        cursor.execute("UPDATE conversation_members SET last_read_id = ? WHERE conversation_id = ?",
+                       (last_id, conversation['id']))
+    else:
+        user1, user2 = target['users']
+        cursor.executemany(
+            """
+            INSERT INTO conversation_summary
+                (username, conversation_id, partner_username, last_message_id, last_timestamp, unread_count)
+            VALUES (?, ?, ?, ?, ?, 0)
+            ON CONFLICT (username, conversation_id) DO UPDATE SET
+                last_message_id = excluded.last_message_id,
+                last_timestamp = excluded.last_timestamp
+            """,
+            [(user1, conversation['id'], user2, last_id, batch[-1]['timestamp']),
+             (user2, conversation['id'], user1, last_id, batch[-1]['timestamp'])]
+        )
+    cursor.executemany(
+        "INSERT OR REPLACE INTO job_checkpoints (job, position) VALUES (?, ?)",
+        [(job, position), (f"{job}:conversation", header_position)]
+    )
+
+@instrument("transfer.import_conversations")
+def import_conversations(src_dir, batch_size=IMPORT_BATCH_SIZE):
+    """Imports an export directory, re-encrypting everything under this database's keys.
+
+    Every batch is committed together with the position in messages.jsonl it
+    reached, so an interrupted import resumes from there when called again.
+    Returns the number of messages imported by this call.
+    """
+    path = os.path.join(src_dir, MESSAGES_FILE)
+    job = IMPORT_JOB_PREFIX + os.path.abspath(path)
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT job, position FROM job_checkpoints WHERE job IN (?, ?)", (job, f"{job}:conversation"))
+        checkpoints = {row['job']: row['position'] for row in cursor.fetchall()}
+    position = checkpoints.get(job, 0)
+    header_position = checkpoints.get(f"{job}:conversation", 0)
+
+    imported = 0
+    with open(path, "rb") as f:
+        target = None
+        if position:
+            # Resuming mid-conversation: re-read the record of the conversation being imported.
+            f.seek(header_position)
+            target = _import_conversation(json.loads(f.readline()), job)
+            f.seek(position)
+        batch = []
+
+        def commit(end):
+            nonlocal batch, imported
+            if batch:
+                writer.run(lambda cursor: _insert_batch(cursor, target, batch, job, end, header_position))
+                imported += len(batch)
+            batch = []
+
+        while True:
+            start = f.tell()
+            line = f.readline()
+            if not line:
+                commit(start)
+                break
+            record = json.loads(line)
+            if record['type'] == 'message':
+                if target is None:
+                    continue
+                prepared = _prepare_message(record, target, src_dir)
+                if prepared is None:
+                    print(f"Skipping message {record['id']}: its content was not exported")
+                    continue
+                batch.append(prepared)
+                if len(batch) >= batch_size:
+                    commit(f.tell())
+                continue
+            commit(start)
+            if record['type'] == 'user':
+                _import_user(record)
+            elif record['type'] == 'conversation':
+                target = _import_conversation(record, job)
+                header_position = start
+    return imported
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Export conversations to JSONL, or import such an export.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    export_parser = subparsers.add_parser("export", help="write conversations to a directory")
+    export_parser.add_argument("directory")
+    export_parser.add_argument("--chat", nargs=2, action="append", metavar=("USER", "PARTNER"),
+                               help="only this chat (PARTNER may be a #group); repeat for more")
+    export_parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+    import_parser = subparsers.add_parser("import", help="read an export into this database")
+    import_parser.add_argument("directory")
+    import_parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    args = parser.parse_args()
+    ensure_schema()
+    if args.command == "export":
+        ids = {get_or_create_conversation(user, partner)['id'] for user, partner in args.chat} if args.chat else None
+        print(f"Exported {export_conversations(args.directory, ids, args.batch_size)} messages.")
+    else:
+        print(f"Imported {import_conversations(args.directory, args.batch_size)} messages.")
@@ -0,0 +1,84 @@
+# writer.py
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from database import get_db_connection
+from metrics import instrument
+
+# Writes from every session are collected by one background thread and
+# committed together, so a burst of sends costs one fsync instead of one each.
+BATCH_MAX_ROWS = 64      # Most jobs committed in a single transaction
+BATCH_MAX_WAIT_MS = 2    # How long the writer waits for more jobs before committing
+WRITE_QUEUE_ENABLED = True  # Set to False to run every write inline, e.g. in tests
+
+_queue = queue.Queue()
+_thread = None
+_thread_lock = threading.Lock()
+
+def submit(job):
+    """Queues job(cursor) for the next batch and returns a Future for its result.
+
+    The Future resolves once the transaction containing the job has committed.
+    If the job raises, only its own changes are rolled back and the Future
+    carries the exception.
+    """
+    future = Future()
+    if not WRITE_QUEUE_ENABLED:
+        _run_batch([(job, future)])
+        return future
+    _ensure_writer_started()
+    _queue.put((job, future))
+    return future
+
+def run(job):
+    """Runs job(cursor) through the write queue and waits until it is committed."""
+    return submit(job).result()
+
+def _ensure_writer_started():
+    global _thread
+    if _thread is not None:
+        return
+    with _thread_lock:
+        if _thread is None:
+            _thread = threading.Thread(target=_writer_loop, name="chat-writer", daemon=True)
+            _thread.start()
+
+def _writer_loop():
+    while True:
+        batch = [_queue.get()]
+        deadline = time.monotonic() + BATCH_MAX_WAIT_MS / 1000
+        while len(batch) < BATCH_MAX_ROWS:
+            try:
+                batch.append(_queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        _run_batch(batch)
+
+@instrument("writer.batch")
+def _run_batch(batch):
+    """Runs every job in one transaction, each inside its own savepoint."""
+    results = []
+    try:
+        with get_db_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                cursor.execute("SAVEPOINT job")
+                try:
+                    results.append((future, job(cursor), None))
+                except Exception as e:
+                    cursor.execute("ROLLBACK TO SAVEPOINT job")
+                    results.append((future, None, e))
+                cursor.execute("RELEASE SAVEPOINT job")
+            conn.commit()
+    except Exception as e:
+        for job, future in batch:
+            future.set_exception(e)
+        return
+    for future, result, error in results:
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)